@@ -0,0 +1,37 @@
+from syncrawl.feed import FeedConsumer, ItemFeed
+
+import argparse
+import logging
+import sys
+
+logging.basicConfig(level=logging.INFO)
+
+def main():
+    parser = argparse.ArgumentParser(description="Print item changes after a consumer's watermark as JSON lines")
+    parser.add_argument("--db", required=True, help="MongoDB database name")
+    parser.add_argument("--consumer", required=True, help="Name the watermark is stored under")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--interval", type=float, default=5, help="Seconds to wait for new changes")
+    parser.add_argument("--follow", action="store_true", help="Keep waiting for new changes")
+    parser.add_argument("--reset", choices=["start", "now"], default=None,
+                        help="Move the watermark to the start of the feed or to its end first")
+    args = parser.parse_args()
+    from pymongo import MongoClient
+    from bson import json_util
+    db = MongoClient()[args.db]
+    consumer = FeedConsumer(db, args.consumer)
+    if args.reset == "start":
+        consumer.reset(0)
+    elif args.reset == "now":
+        consumer.reset(ItemFeed(db).last_seq())
+    n_events = 0
+    for events in consumer.tail(args.batch_size, args.interval, args.follow):
+        for event in events:
+            sys.stdout.write(json_util.dumps(event) + "\n")
+        # the batch is committed when the next one is asked for, once it is written out
+        sys.stdout.flush()
+        n_events += len(events)
+        logging.info(f"{n_events} changes read, watermark {events[-1]['_id']}")
+    
+if __name__ == "__main__":
+    main()
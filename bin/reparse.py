@@ -0,0 +1,28 @@
+from syncrawl.reparse import Reparser
+
+import argparse
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-parse cached pages offline and rewrite their items")
+    parser.add_argument("--db", required=True, help="MongoDB database name")
+    parser.add_argument("--cache", required=True, help="Page cache directory")
+    parser.add_argument("--module", action="append", required=True,
+                        help="Module defining the Page classes (can be repeated)")
+    parser.add_argument("--source", choices=Reparser.sources, default="queue")
+    parser.add_argument("--page-name", action="append", default=None,
+                        help="Only re-parse pages with this page_name (can be repeated)")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--checkpoint", default=None, help="Checkpoint file to resume from")
+    parser.add_argument("--item-feed", action="store_true", help="Log item changes to the item feed")
+    args = parser.parse_args()
+    reparser = Reparser(args.db, args.cache, args.module, args.processes, args.batch_size, args.checkpoint,
+                        args.item_feed)
+    counts = reparser.run(args.source, args.page_name)
+    print(counts)
+    
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,8 @@ setup(
     entry_points={
         'console_scripts': [
             'run-web-server=bin.run_web_server:main',
+            'reparse-pages=bin.reparse:main',
+            'tail-item-feed=bin.item_feed:main',
         ],
     },
     classifiers=[
@@ -29,7 +31,11 @@ setup(
         "flask_pymongo==2.3.0",
         "lxml==5.2.1",
         "requests==2.31.0",
+        "urllib3>=2.0",
         "pymongo==4.7.2",
         "pytest==8.2.0",
     ],
+    extras_require={
+        "css": ["cssselect"],
+    },
 )
@@ -0,0 +1,225 @@
+from collections import OrderedDict
+from datetime import datetime
+import hashlib
+import uuid
+import os
+import time
+
+
+class CacheManager:
+    # Bodies are content addressed: each distinct body is stored once, as
+    # bodies/<sha1>, and <md5 of the url>.ref holds the sha1 of its body, so
+    # aliased urls returning the same page share one file. Files of older
+    # caches (the body stored as <md5 of the url>) are still read.
+    # A body is deleted once no url refers to it any more (its url stored a
+    # new body, or was evicted); the refcount is only built the first time
+    # it is needed. With max_entries, the least recently used urls are
+    # evicted; with max_age (seconds), older entries are misses. A shared
+    # cache (e.g. a network filesystem used by several nodes) checks the
+    # directory on each lookup instead of trusting the startup listing, and
+    # never deletes bodies, since urls of other nodes may still refer to them.
+    def __init__(self, path, max_entries=None, max_age=None, shared=False):
+        os.makedirs(os.path.join(path, "bodies"), exist_ok=True)
+        self._path = path
+        self._max_entries = max_entries
+        self._max_age = max_age
+        self._shared = shared
+        fnames = [ fname for fname in os.listdir(path) if fname != "bodies" and not fname.endswith(".tmp") ]
+        if max_entries is not None:
+            fnames.sort(key=lambda fname: os.path.getmtime(os.path.join(path, fname)))
+        self._cached = OrderedDict.fromkeys([ fname[:-len(".ref")] if fname.endswith(".ref") else fname for fname in fnames ])
+        # body hash -> urls referring to it, built on first use
+        self._refs = None
+
+    @classmethod
+    def cache_key(cls, url):
+        return hashlib.md5(url.encode()).hexdigest()
+
+    @classmethod
+    def body_hash(cls, content):
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def _ref_fpath(self, md5):
+        return os.path.join(self._path, md5 + ".ref")
+
+    def _body_fpath(self, body_hash):
+        return os.path.join(self._path, "bodies", body_hash)
+
+    def _read_ref(self, md5):
+        try:
+            with open(self._ref_fpath(md5)) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def _write_atomic(cls, fpath, content):
+        # written aside and renamed, so concurrent readers never see partial
+        # files. The random temp name keeps writers apart, also across nodes
+        # sharing the directory (where pids collide)
+        tmp_fpath = f"{fpath}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_fpath, 'x') as f:
+                f.write(content)
+            os.replace(tmp_fpath, fpath)
+        except BaseException:
+            cls._remove(tmp_fpath)
+            raise
+
+    def _is_expired(self, fpath):
+        return self._max_age is not None and time.time() - os.path.getmtime(fpath) >= self._max_age
+
+    def stored_at_of(self, url):
+        md5 = self.cache_key(url)
+        for fpath in [self._ref_fpath(md5), os.path.join(self._path, md5)]:
+            try:
+                return datetime.fromtimestamp(os.path.getmtime(fpath))
+            except FileNotFoundError:
+                pass
+        return None
+
+    def retrieve_cached(self, url):
+        md5 = self.cache_key(url)
+        if not self._shared and md5 not in self._cached:
+            return None
+        ref_fpath = self._ref_fpath(md5)
+        try:
+            if os.path.exists(ref_fpath):
+                if self._is_expired(ref_fpath):
+                    return None
+                fpath = self._body_fpath(self._read_ref(md5))
+            else:
+                fpath = os.path.join(self._path, md5)
+                if self._is_expired(fpath):
+                    return None
+            with open(fpath, 'r') as f:
+                content = f.read()
+        except FileNotFoundError:
+            self._cached.pop(md5, None)
+            return None
+        self._touch(md5)
+        return content
+
+    def store_cache(self, url, content, stored_at=None):
+        # stored_at backdates an entry copied from another cache, so it
+        # expires with the original
+        md5 = self.cache_key(url)
+        body_hash = self.body_hash(content)
+        body_fpath = self._body_fpath(body_hash)
+        if not os.path.exists(body_fpath):
+            self._write_atomic(body_fpath, content)
+        old_hash = self._read_ref(md5)
+        self._write_atomic(self._ref_fpath(md5), body_hash)
+        if stored_at is not None:
+            os.utime(self._ref_fpath(md5), (stored_at.timestamp(), stored_at.timestamp()))
+        legacy_fpath = os.path.join(self._path, md5)
+        if os.path.exists(legacy_fpath):
+            os.remove(legacy_fpath)
+        if self._refs is not None:
+            self._refs.setdefault(body_hash, set()).add(md5)
+        if old_hash is not None and old_hash != body_hash:
+            self._unref(old_hash, md5)
+        self._touch(md5)
+        self._evict()
+
+    def _touch(self, md5):
+        self._cached[md5] = None
+        self._cached.move_to_end(md5)
+
+    def _load_refs(self):
+        if self._refs is None:
+            self._refs = {}
+            for md5 in self._cached:
+                body_hash = self._read_ref(md5)
+                if body_hash is not None:
+                    self._refs.setdefault(body_hash, set()).add(md5)
+        return self._refs
+
+    def _unref(self, body_hash, md5):
+        if self._shared:
+            return
+        refs = self._load_refs().get(body_hash, set())
+        refs.discard(md5)
+        if len(refs) == 0:
+            self._refs.pop(body_hash, None)
+            self._remove(self._body_fpath(body_hash))
+
+    @classmethod
+    def _remove(cls, fpath):
+        try:
+            os.remove(fpath)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self._max_entries is not None and len(self._cached) > self._max_entries:
+            md5, _ = self._cached.popitem(last=False)
+            body_hash = self._read_ref(md5)
+            self._remove(self._ref_fpath(md5))
+            self._remove(os.path.join(self._path, md5))
+            if body_hash is not None:
+                self._unref(body_hash, md5)
+
+
+class GridFSCache:
+    # Shared cache in the crawl database. Bodies are stored once in GridFS
+    # under their sha1, and <bucket_name>.urls maps each url to its body.
+    def __init__(self, db, bucket_name="page_cache", max_age=None):
+        import gridfs
+        self._fs = gridfs.GridFSBucket(db, bucket_name=bucket_name)
+        self._files = db[bucket_name + ".files"]
+        self._urls = db[bucket_name + ".urls"]
+        self._urls.create_index("body_hash")
+        self._max_age = max_age
+
+    def stored_at_of(self, url):
+        url_doc = self._urls.find_one({"_id": CacheManager.cache_key(url)}, {"stored_at": 1})
+        return url_doc["stored_at"] if url_doc is not None else None
+
+    def retrieve_cached(self, url):
+        import gridfs
+        url_doc = self._urls.find_one({"_id": CacheManager.cache_key(url)})
+        if url_doc is None:
+            return None
+        if self._max_age is not None and (datetime.now() - url_doc["stored_at"]).total_seconds() >= self._max_age:
+            return None
+        try:
+            with self._fs.open_download_stream_by_name(url_doc["body_hash"]) as stream:
+                return stream.read().decode()
+        except gridfs.errors.NoFile:
+            return None
+
+    def store_cache(self, url, content, stored_at=None):
+        body_hash = CacheManager.body_hash(content)
+        if self._files.count_documents({"filename": body_hash}, limit=1) == 0:
+            self._fs.upload_from_stream(body_hash, content.encode())
+        old_doc = self._urls.find_one_and_update(
+            {"_id": CacheManager.cache_key(url)},
+            {"$set": {"url": url, "body_hash": body_hash, "stored_at": stored_at or datetime.now()}},
+            upsert=True,
+        )
+        if old_doc is not None and old_doc["body_hash"] != body_hash and \
+           self._urls.count_documents({"body_hash": old_doc["body_hash"]}, limit=1) == 0:
+            for old in self._files.find({"filename": old_doc["body_hash"]}, {"_id": 1}):
+                self._fs.delete(old["_id"])
+
+
+class TieredCache:
+    # Read-through over a local L1 and a shared L2: L2 hits fill L1 (keeping
+    # the time they were stored in L2, so max_age still holds), and stores
+    # go to both, so each url is downloaded once across the fleet
+    def __init__(self, l1, l2):
+        self._l1 = l1
+        self._l2 = l2
+
+    def retrieve_cached(self, url):
+        content = self._l1.retrieve_cached(url)
+        if content is None:
+            content = self._l2.retrieve_cached(url)
+            if content is not None:
+                self._l1.store_cache(url, content, stored_at=self._l2.stored_at_of(url))
+        return content
+
+    def store_cache(self, url, content):
+        self._l1.store_cache(url, content)
+        self._l2.store_cache(url, content)
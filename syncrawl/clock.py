@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta
+import time
+
+
+class SystemClock:
+    def now(self):
+        return datetime.now()
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class VirtualClock:
+    # Time only moves when someone sleeps or advances it, so simulated runs
+    # take as long as their computations, not as the waits they model
+    def __init__(self, start=None):
+        self._now = start if start is not None else datetime.now()
+
+    def now(self):
+        return self._now
+
+    def time(self):
+        return self._now.timestamp()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self._now += timedelta(seconds=seconds)
+
+    def advance_to(self, dt):
+        if dt > self._now:
+            self._now = dt
+
+
+system_clock = SystemClock()
@@ -0,0 +1,122 @@
+from .clock import system_clock
+
+from datetime import timedelta
+import json
+
+
+class ItemFeed:
+    # Ordered log of item changes in item_changes. Each event gets the next
+    # value of a counter as its _id: {_id, op: insert|update|delete, item,
+    # page: {page_name, key}, at}. Delete events carry the last stored item.
+    ops = ["insert", "update", "delete"]
+
+    def __init__(self, db, ttl=None, clock=None):
+        self._clock = clock if clock is not None else system_clock
+        self._ic = db.item_changes
+        self._counters = db.crawl_counters
+        if ttl is not None:
+            # ttl: seconds events are kept, consumers lagging further behind miss them
+            self._ic.create_index("at", expireAfterSeconds=ttl)
+
+    @classmethod
+    def digest(cls, item_json):
+        # tuples are stored as lists, so compare the serialized forms
+        return json.dumps(item_json, sort_keys=True, default=str)
+
+    @classmethod
+    def diff(cls, old_items, new_items):
+        # old_items, new_items: {item_id: item_json}; returns [(op, item_json)]
+        changes = []
+        for item_id, item_json in new_items.items():
+            if item_id not in old_items:
+                changes.append(("insert", item_json))
+            elif cls.digest(old_items[item_id]) != cls.digest(item_json):
+                changes.append(("update", item_json))
+        for item_id, item_json in old_items.items():
+            if item_id not in new_items:
+                changes.append(("delete", item_json))
+        return changes
+
+    def _reserve(self, n):
+        from pymongo import ReturnDocument
+        counter = self._counters.find_one_and_update(
+            {"_id": "item_changes"}, {"$inc": {"seq": n}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+        return counter["seq"] - n + 1
+
+    def record(self, page, changes):
+        if len(changes) == 0:
+            return
+        first_seq = self._reserve(len(changes))
+        page_json = page.page_filter()
+        at = self._clock.now()
+        self._ic.insert_many([ {
+            "_id": first_seq + i,
+            "op": op,
+            "item": item_json,
+            "page": page_json,
+            "at": at,
+        } for i, (op, item_json) in enumerate(changes) ])
+
+    def last_seq(self):
+        counter = self._counters.find_one({"_id": "item_changes"})
+        return counter["seq"] if counter is not None else 0
+
+    def read(self, after=0, limit=1000, gap_timeout=60):
+        # events after seq `after`, in order. Seqs are reserved before their
+        # events are inserted, so a concurrent writer can leave a gap for a
+        # moment: reading stops at a gap until the event after it is
+        # gap_timeout seconds old (its writer is then assumed to have died).
+        events = list(self._ic.find({"_id": {"$gt": after}}).sort("_id", 1).limit(limit))
+        expected = after + 1
+        for i, event in enumerate(events):
+            if event["_id"] != expected and event["at"] > self._clock.now() - timedelta(seconds=gap_timeout):
+                return events[:i]
+            expected = event["_id"] + 1
+        return events
+
+
+class FeedConsumer:
+    # Reads an ItemFeed from a watermark stored in item_feed_consumers under
+    # name. Events are delivered at least once: commit() after handling them.
+    def __init__(self, db, name, gap_timeout=60, clock=None):
+        self._clock = clock if clock is not None else system_clock
+        self._feed = ItemFeed(db, clock=self._clock)
+        self._consumers = db.item_feed_consumers
+        self._name = name
+        self._gap_timeout = gap_timeout
+        consumer = self._consumers.find_one({"_id": name})
+        self._watermark = consumer["seq"] if consumer is not None else 0
+
+    @property
+    def watermark(self):
+        return self._watermark
+
+    def poll(self, limit=1000):
+        return self._feed.read(self._watermark, limit, self._gap_timeout)
+
+    def commit(self, events):
+        if len(events) == 0:
+            return
+        self._watermark = events[-1]["_id"]
+        self._consumers.update_one(
+            {"_id": self._name},
+            {"$set": {"seq": self._watermark, "committed_at": self._clock.now()}},
+            upsert=True)
+
+    def reset(self, seq=0):
+        # seq=0 replays the retained feed, seq=ItemFeed.last_seq() skips to now
+        self._watermark = seq
+        self._consumers.update_one({"_id": self._name}, {"$set": {"seq": seq}}, upsert=True)
+
+    def tail(self, batch_size=1000, interval=5, follow=True):
+        # yields batches of events, committing each one when the next is asked for
+        while True:
+            events = self.poll(batch_size)
+            if len(events) > 0:
+                yield events
+                self.commit(events)
+            elif not follow:
+                return
+            else:
+                self._clock.sleep(interval)
@@ -0,0 +1,122 @@
+from contextlib import contextmanager
+import threading
+import logging
+import random
+import signal
+import time
+import sys
+import os
+
+
+class StackSampler:
+    # Statistical profiler: while a sampled call runs, a background thread
+    # records the stack of the calling thread every `interval` seconds.
+    # Stacks are aggregated per page_name and written in collapsed format
+    # (flamegraph.pl / speedscope input).
+    def __init__(self, output_dir, sample_rate=0.05, interval=0.005, enabled=False,
+                 max_stacks=10000, flush_every=100):
+        self._output_dir = output_dir
+        self._sample_rate = sample_rate
+        self._interval = interval
+        self._enabled = enabled
+        self._max_stacks = max_stacks
+        self._flush_every = flush_every
+        self._stacks = {}
+        self._n_profiled = 0
+        self._lock = threading.Lock()
+        self._target = None
+        self._active = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    def enable(self):
+        self._enabled = True
+        logging.info(f"Profiling enabled, sampling {self._sample_rate:.1%} of the requests")
+
+    def disable(self):
+        self._enabled = False
+        self.flush()
+        logging.info(f"Profiling disabled, profiles written to {self._output_dir}")
+
+    def toggle(self, *args):
+        if self._enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def install_signal_handler(self, signal_name="SIGUSR1"):
+        # signal handlers can only be installed from the main thread, and not
+        # every platform has SIGUSR1
+        signum = getattr(signal, signal_name, None)
+        if signum is None:
+            logging.warning(f"{signal_name} is not available on this platform, profiling can't be toggled with it")
+            return False
+        if threading.current_thread() is not threading.main_thread():
+            logging.warning(f"Not in the main thread, profiling can't be toggled with {signal_name}")
+            return False
+        signal.signal(signum, self.toggle)
+        return True
+
+    def _start_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="syncrawl-profiler", daemon=True)
+            self._thread.start()
+
+    @contextmanager
+    def profile(self, page_name):
+        if not self._enabled or random.random() >= self._sample_rate:
+            yield
+            return
+        self._start_thread()
+        self._target = (threading.get_ident(), page_name)
+        self._active.set()
+        try:
+            yield
+        finally:
+            self._active.clear()
+            self._target = None
+            self._n_profiled += 1
+            if self._n_profiled % self._flush_every == 0:
+                self.flush()
+
+    @classmethod
+    def collapse(cls, frame):
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            labels.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(labels))
+
+    def _run(self):
+        while True:
+            self._active.wait()
+            time.sleep(self._interval)
+            target = self._target
+            if target is None:
+                continue
+            thread_id, page_name = target
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            stack = self.collapse(frame)
+            with self._lock:
+                stacks = self._stacks.setdefault(page_name, {})
+                if stack not in stacks and len(stacks) >= self._max_stacks:
+                    stack = "[truncated]"
+                stacks[stack] = stacks.get(stack, 0) + 1
+
+    def flush(self):
+        with self._lock:
+            snapshot = { page_name: dict(stacks) for page_name, stacks in self._stacks.items() }
+        if len(snapshot) == 0:
+            return
+        os.makedirs(self._output_dir, exist_ok=True)
+        for page_name, stacks in snapshot.items():
+            fpath = os.path.join(self._output_dir, f"{page_name}.collapsed")
+            with open(fpath, 'w') as f:
+                for stack, count in sorted(stacks.items(), key=lambda e: -e[1]):
+                    f.write(f"{stack} {count}\n")
@@ -0,0 +1,153 @@
+from .syncrawl import (
+    Page,
+    PageRequest,
+    CacheManager,
+    ItemStore,
+    ParsingOutput,
+    RequestQueue,
+)
+
+from multiprocessing import Pool
+from datetime import datetime
+import importlib
+import traceback
+import logging
+import json
+import os
+import time
+
+_worker_cache = None
+
+def _init_worker(cache_path, modules):
+    global _worker_cache
+    for module in modules:
+        importlib.import_module(module)
+    _worker_cache = CacheManager(cache_path)
+
+def _reparse_page(page_json):
+    content = _worker_cache.retrieve_cached(page_json["url"])
+    if content is None:
+        return page_json, "missing", None, None, None
+    try:
+        page = Page.from_json(page_json)
+        output = page.parse_content(content)
+        if not isinstance(output, ParsingOutput):
+            result = output
+            output = ParsingOutput()
+            output.extend(result)
+        return page_json, "parsed", list(output.items), list(output.pages), None
+    except Exception as e:
+        return page_json, "failed", None, None, f"{e}\n{traceback.format_exc()}"
+
+
+class Reparser:
+    sources = ["queue", "history", "archived"]
+
+    def __init__(self, db_name, cache_path, modules=[], processes=None, batch_size=500,
+                 checkpoint_path=None, item_feed=False):
+        from pymongo import MongoClient
+        self._client = MongoClient()
+        self._db = self._client[db_name]
+        self._cache_path = cache_path
+        self._modules = modules
+        self._processes = processes
+        self._batch_size = batch_size
+        self._checkpoint_path = checkpoint_path
+        # pages found are queued in the shards the crawlers lease from
+        self._request_queue = RequestQueue(self._db, n_shards=RequestQueue.stored_shards(self._db))
+        for module in modules:
+            importlib.import_module(module)
+        # after the modules, so that the item indexes they declare are created
+        self._item_store = ItemStore(self._db, change_feed=item_feed)
+
+    def _load_checkpoint(self):
+        if self._checkpoint_path is None or not os.path.exists(self._checkpoint_path):
+            return None
+        with open(self._checkpoint_path) as f:
+            return json.load(f)
+
+    def _save_checkpoint(self, checkpoint):
+        tmp_path = self._checkpoint_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self._checkpoint_path)
+
+    def _iter_pages(self, source, page_names, after):
+        # one document per distinct page, in a stable order so a run can resume
+        if source == "queue":
+            collection, prefix = self._db.request_queue, "payload.page."
+        elif source == "history":
+            collection, prefix = self._db.request_history, "payload.page."
+        elif source == "archived":
+            collection, prefix = self._db.archived_pages, ""
+        else:
+            raise ValueError(f"Unknown source: {source}")
+        match = {}
+        if page_names is not None:
+            match[prefix + "page_name"] = {"$in": page_names}
+        pipeline = [
+            {"$match": match},
+            {"$group": {
+                "_id": {"page_name": "$" + prefix + "page_name", "key": "$" + prefix + "key"},
+                "page": {"$last": "$" + prefix[:-1] if prefix != "" else "$$ROOT"},
+            }},
+            {"$sort": {"_id": 1}},
+        ]
+        if after is not None:
+            pipeline.append({"$match": {"_id": {"$gt": after}}})
+        for group in collection.aggregate(pipeline, allowDiskUse=True):
+            yield group["_id"], group["page"]
+
+    def _write_batch(self, results):
+        page_items = []
+        new_requests = []
+        for page_json, status, items, pages, error in results:
+            if status != "parsed":
+                continue
+            page = Page.from_json(page_json)
+            if len(items) > 0:
+                page_items.append((page, items))
+            for new_page in pages:
+                new_requests.append(PageRequest(new_page, None, datetime.now()))
+        self._item_store.replace_items(page_items)
+        new_requests = self._request_queue.filter_archived(new_requests)
+        return self._request_queue.add_requests(new_requests)
+
+    def run(self, source="queue", page_names=None):
+        checkpoint = self._load_checkpoint()
+        if checkpoint is None or checkpoint["source"] != source or checkpoint["page_names"] != page_names:
+            checkpoint = {
+                "source": source,
+                "page_names": page_names,
+                "last_id": None,
+                "counts": {"parsed": 0, "missing": 0, "failed": 0, "requests": 0},
+            }
+        else:
+            logging.info(f"Resuming re-parse after {checkpoint['last_id']}")
+        counts = checkpoint["counts"]
+        started_at = time.time()
+        processed = 0
+        pages = self._iter_pages(source, page_names, checkpoint["last_id"])
+        with Pool(self._processes, _init_worker, (self._cache_path, self._modules)) as pool:
+            while True:
+                batch = []
+                for page_id, page_json in pages:
+                    batch.append(page_json)
+                    last_id = page_id
+                    if len(batch) >= self._batch_size:
+                        break
+                if len(batch) == 0:
+                    break
+                results = pool.map(_reparse_page, batch)
+                for page_json, status, _, _, error in results:
+                    counts[status] += 1
+                    if status == "failed":
+                        logging.warning(f"Parsing failed for {page_json['page_name']} {page_json['key']}: {error}")
+                counts["requests"] += self._write_batch(results)
+                processed += len(batch)
+                checkpoint["last_id"] = last_id
+                if self._checkpoint_path is not None:
+                    self._save_checkpoint(checkpoint)
+                rate = processed / max(time.time() - started_at, 1e-6)
+                logging.info(f"Re-parsed {processed} pages ({rate:.1f} pages/s): {counts}")
+        return counts
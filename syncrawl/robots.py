@@ -0,0 +1,94 @@
+from urllib.parse import urlsplit
+import gzip
+import logging
+import time
+
+
+class RobotsDisallowedError(Exception):
+    def __init__(self, msg):
+        self.message = msg
+
+
+class RobotsCache:
+    def __init__(self, user_agent="*", ttl=24*3600, timeout=10):
+        self._user_agent = user_agent
+        self._ttl = ttl
+        self._timeout = timeout
+        self._rules = {}
+
+    @classmethod
+    def host_of(cls, url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def _fetch_rules(self, host):
+        import requests
+        from urllib.robotparser import RobotFileParser
+        rules = RobotFileParser(host + "/robots.txt")
+        try:
+            response = requests.get(host + "/robots.txt", timeout=self._timeout)
+        except requests.RequestException as e:
+            logging.info(f"Could not fetch robots.txt from {host} ({e}), allowing all")
+            rules.allow_all = True
+            return rules
+        if response.status_code in (401, 403):
+            rules.disallow_all = True
+        elif response.status_code >= 400:
+            rules.allow_all = True
+        else:
+            rules.parse(response.text.splitlines())
+        return rules
+
+    def get_rules(self, url):
+        host = self.host_of(url)
+        cached = self._rules.get(host)
+        if cached is None or time.time() >= cached[0] + self._ttl:
+            logging.info(f"Fetching robots.txt: {host}")
+            cached = (time.time(), self._fetch_rules(host))
+            self._rules[host] = cached
+        return cached[1]
+
+    def can_fetch(self, url):
+        return self.get_rules(url).can_fetch(self._user_agent, url)
+
+    def crawl_delay(self, url):
+        delay = self.get_rules(url).crawl_delay(self._user_agent)
+        return float(delay) if delay is not None else 0
+
+    def sitemaps(self, url):
+        sitemaps = self.get_rules(url).site_maps()
+        return sitemaps if sitemaps is not None else []
+
+
+def iter_sitemap_urls(sitemap_url, timeout=30, max_depth=3):
+    # Streams <loc> entries without holding the document in memory. Sitemap
+    # indexes are followed once the index itself has been read.
+    import requests
+    from lxml import etree
+    logging.info(f"Reading sitemap: {sitemap_url}")
+    response = requests.get(sitemap_url, stream=True, timeout=timeout)
+    response.raise_for_status()
+    response.raw.decode_content = True
+    stream = response.raw
+    content_type = response.headers.get("Content-Type", "")
+    if sitemap_url.endswith(".gz") or "gzip" in content_type:
+        stream = gzip.GzipFile(fileobj=stream)
+    child_sitemaps = []
+    try:
+        for _, element in etree.iterparse(stream, events=("end",), tag=("{*}url", "{*}sitemap")):
+            loc = element.findtext("{*}loc")
+            if loc is not None and loc.strip() != "":
+                if etree.QName(element).localname == "sitemap":
+                    child_sitemaps.append(loc.strip())
+                else:
+                    yield loc.strip()
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+    finally:
+        response.close()
+    if max_depth == 0 and len(child_sitemaps) > 0:
+        logging.info(f"Maximum sitemap depth reached, ignoring {len(child_sitemaps)} sitemaps in {sitemap_url}")
+        return
+    for child_url in child_sitemaps:
+        yield from iter_sitemap_urls(child_url, timeout, max_depth - 1)
@@ -0,0 +1,172 @@
+from .syncrawl import Crawler, HTTPDownloader
+from .clock import VirtualClock
+
+from datetime import datetime, timedelta
+import bisect
+import logging
+import random
+
+
+class SiteModel:
+    # Synthetic site: each url changes as a Poisson process with
+    # change_rate(url) changes per day, and links to links(url).
+    # Change times are drawn lazily and deterministically from seed.
+    def __init__(self, change_rate, links=None, latency=0.2, seed=0):
+        self._change_rate = change_rate if callable(change_rate) else (lambda url: change_rate)
+        self._links = links if links is not None else (lambda url: [])
+        self.latency = latency
+        self.start = None
+        self._seed = seed
+        self._changes = {}
+
+    def _changes_until(self, url, until):
+        if url not in self._changes:
+            self._changes[url] = (random.Random(f"{self._seed}:{url}"), [])
+        rng, changes = self._changes[url]
+        rate = self._change_rate(url) / 86400
+        if rate <= 0:
+            return changes
+        last = changes[-1] if len(changes) > 0 else self.start
+        while last <= until:
+            last = last + timedelta(seconds=rng.expovariate(rate))
+            changes.append(last)
+        return changes
+
+    def version_at(self, url, at):
+        return bisect.bisect_right(self._changes_until(url, at), at)
+
+    def first_change_after(self, url, after, until):
+        changes = self._changes_until(url, until)
+        i = bisect.bisect_right(changes, after)
+        return changes[i] if i < len(changes) and changes[i] <= until else None
+
+    def render(self, url, version):
+        links = "".join([ f'<a href="{link}">{link}</a>' for link in self._links(url) ])
+        return f'<html><body><h1>{url}</h1><p class="version">{version}</p>{links}</body></html>'
+
+    def content(self, url, at):
+        return self.render(url, self.version_at(url, at))
+
+
+class SimulationReport:
+    def __init__(self):
+        self.fetches = {}
+        self.n_fetches = 0
+        self.n_changed = 0
+        self.lags = []
+        self.queue_sizes = []
+
+    def fetched(self, lag):
+        # lag: time the newest content went unseen, None when nothing changed
+        self.n_fetches += 1
+        if lag is not None:
+            self.n_changed += 1
+            self.lags.append(lag)
+
+    def processed(self, page_name):
+        self.fetches[page_name] = self.fetches.get(page_name, 0) + 1
+
+    @property
+    def mean_lag(self):
+        if len(self.lags) == 0:
+            return None
+        return sum(self.lags, timedelta()) / len(self.lags)
+
+    @property
+    def max_lag(self):
+        return max(self.lags) if len(self.lags) > 0 else None
+
+    def summary(self):
+        lines = [
+            f"Fetches: {self.n_fetches} ({self.n_changed} found changes, {self.n_fetches - self.n_changed} unchanged)",
+            f"Fetches per page: {self.fetches}",
+            f"Freshness lag: mean {self.mean_lag}, max {self.max_lag}",
+        ]
+        if len(self.queue_sizes) > 0:
+            sizes = [ size for _, size in self.queue_sizes ]
+            lines.append(f"Queue size: start {sizes[0]}, end {sizes[-1]}, max {max(sizes)}")
+        return "\n".join(lines)
+
+
+class SimulatedDownloader(HTTPDownloader):
+    def __init__(self, site, report, request_delay=0, clock=None):
+        super().__init__(None, request_delay, clock=clock)
+        self._site = site
+        self._report = report
+        self._last_fetched_at = {}
+
+    def _download(self, url):
+        self._clock.sleep(self._site.latency)
+        now = self._clock.now()
+        last_fetched_at = self._last_fetched_at.get(url)
+        if last_fetched_at is not None:
+            change = self._site.first_change_after(url, last_fetched_at, now)
+            self._report.fetched(now - change if change is not None else None)
+        else:
+            self._report.fetched(None)
+        self._last_fetched_at[url] = now
+        return self._site.content(url, now)
+
+
+class _Idle(Exception):
+    pass
+
+
+class Simulator:
+    # Runs a Crawler (with the registered pages and root pages) against a
+    # SiteModel in virtual time. The crawl database is dropped first, so use
+    # one dedicated to simulations.
+    def __init__(self, db_name, site, start=None, **crawler_kwargs):
+        from pymongo import MongoClient
+        MongoClient().drop_database(db_name)
+        self._clock = VirtualClock(start if start is not None else datetime.now().replace(microsecond=0))
+        self._site = site
+        if site.start is None:
+            site.start = self._clock.now()
+        self._report = SimulationReport()
+        self._crawler = Crawler(db_name, None, clock=self._clock, **crawler_kwargs)
+        self._crawler._downloader = SimulatedDownloader(
+            site, self._report, crawler_kwargs.get("request_delay", 0), self._clock)
+
+    @property
+    def clock(self):
+        return self._clock
+
+    @property
+    def report(self):
+        return self._report
+
+    def _queue_size(self):
+        return sum([ counts.get("pending", 0) for counts in self._crawler._stats.counts() ])
+
+    def _raise_idle(self):
+        raise _Idle()
+
+    def run(self, duration, sample_every=timedelta(hours=1)):
+        crawler = self._crawler
+        queue = crawler._request_queue
+        end = self._clock.now() + duration
+        next_sample = self._clock.now()
+        crawler._seed_root_pages()
+        while True:
+            while self._clock.now() >= next_sample:
+                self._report.queue_sizes.append((next_sample, self._queue_size()))
+                next_sample += sample_every
+            if self._clock.now() >= end:
+                break
+            due = queue.next_due_at()
+            if due is None or due > self._clock.now():
+                crawler._writes.flush()
+                due = queue.next_due_at()
+            if due is not None and due <= self._clock.now():
+                try:
+                    request = queue.get_next_request(on_idle=self._raise_idle, finishing=crawler._writes.finishing)
+                except _Idle:
+                    continue
+                self._report.processed(request.page.page_name)
+                crawler.process_request(request)
+                continue
+            self._clock.advance_to(min([ dt for dt in [due, next_sample, end] if dt is not None ]))
+        crawler._writes.flush()
+        logging.info(f"Simulated until {self._clock.now()}\n{self._report.summary()}")
+        return self._report
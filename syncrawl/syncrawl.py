@@ -1,22 +1,26 @@
-import requests
-from lxml import etree
-from pymongo import MongoClient
+from .robots import RobotsCache, RobotsDisallowedError, iter_sitemap_urls
+from .profiling import StackSampler
+from .cache import CacheManager, GridFSCache, TieredCache
+from .clock import SystemClock, VirtualClock, system_clock
+from .feed import ItemFeed, FeedConsumer
 
+import math
 import hashlib
-import bisect
-from collections import deque
+import socket
+import threading
 import abc
 from abc import abstractmethod
 import json
 import os
-from datetime import datetime, timedelta
-from inspect import isclass
+import io
+from contextlib import contextmanager
+from datetime import timedelta
+from urllib.parse import urljoin, urlsplit
 import traceback
 import logging
-import argparse
-import time
-import sys
-import pdb
+
+# requests, lxml and pymongo are imported where they are used, so that
+# importing syncrawl (e.g. from CLI tools or at worker start) stays cheap
 
 # Interfaze bat eskeini Item objektuak bakarrik kargatuko dituena, esportazioak egiteko.
 # Datetime-ekin, edozein uneko egoerara itzuli daiteke erraz
@@ -25,6 +29,17 @@ class ParsingError(Exception):
     def __init__(self, msg):
         self.message = msg
 
+class DownloadAbortedError(Exception):
+    # reason: "content_type", "too_large" or "timeout"; only timeouts are retried
+    def __init__(self, msg, reason):
+        super().__init__(msg)
+        self.message = msg
+        self.reason = reason
+
+    @property
+    def permanent(self):
+        return self.reason != "timeout"
+
 class Utils:
     @classmethod
     def are_all_scalar(cls, dictionary):
@@ -37,61 +52,183 @@ class Utils:
                 return False
         return True
     
-class CacheManager:
-    def __init__(self, path):
-        os.makedirs(path, exist_ok=True)
-        self._path = path
-        self._cached = set(os.listdir(path))
-
-    def retrieve_cached(self, url):
-        md5 = hashlib.md5(url.encode()).hexdigest()
-        if md5 not in self._cached:
-            return None
-        fpath = os.path.join(self._path, md5)
-        with open(fpath, 'r') as f:
-            content = f.read()
-        return content
-
-    def store_cache(self, url, content):
-        md5 = hashlib.md5(url.encode()).hexdigest()
-        fpath = os.path.join(self._path, md5)
-        with open(fpath, 'w') as f:
-            f.write(content)
-        self._cached.add(md5)
-
-        
 class HTTPDownloader:
-    def __init__(self, cache_path, request_delay):
-        self._cache = None
-        if cache_path is not None:
+    html_content_types = ("text/html", "application/xhtml+xml")
+
+    def __init__(self, cache_path, request_delay, robots=None, cache=None,
+                 connect_timeout=10, read_timeout=30, total_timeout=120, max_bytes=10*1024*1024,
+                 content_types=html_content_types, head_probe=False, chunk_size=64*1024, clock=None):
+        # cache: any object with retrieve_cached/store_cache, overrides cache_path
+        # content_types: accepted media types, None to accept any
+        self._clock = clock if clock is not None else system_clock
+        self._cache = cache
+        if cache is None and cache_path is not None:
             self._cache = CacheManager(cache_path)
         self._request_delay = request_delay
+        self._robots = robots
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._total_timeout = total_timeout
+        self._max_bytes = max_bytes
+        self._content_types = content_types
+        self._head_probe = head_probe
+        self._chunk_size = chunk_size
+        self._session = None
         self._last_request = None
+        self._last_host_request = {}
 
     def download(self, url):
+        return self.parse(self.fetch(url))
+
+    def fetch(self, url):
         content = None
         if self._cache is not None:
             content = self._cache.retrieve_cached(url)
         if content is None:
-            self._wait()
+            if self._robots is not None and not self._robots.can_fetch(url):
+                raise RobotsDisallowedError(f"Disallowed by robots.txt: {url}")
+            self._wait(url)
             logging.info(f"Downloading: {url}")
-            html = requests.get(url)
-            self._last_request = time.time()
-            content = html.content.decode()
+            try:
+                content = self._download(url)
+            finally:
+                self._last_request = self._clock.time()
+                self._last_host_request[RobotsCache.host_of(url)] = self._last_request
             if self._cache is not None:
                 self._cache.store_cache(url, content)
         else:
             logging.info(f"Retrieving from cache: {url}")
+        return content
+
+    def _download(self, url):
+        # the body is streamed so oversized, slow or non-HTML responses are
+        # dropped without being read into memory
+        if self._session is None:
+            # keeps connections to each host open between requests
+            import requests
+            self._session = requests.Session()
+        timeout = (self._connect_timeout, self._read_timeout)
+        if self._head_probe:
+            head = self._session.head(url, timeout=timeout, allow_redirects=True)
+            self._check_headers(url, head.headers)
+        started_at = self._clock.time()
+        with self._session.get(url, stream=True, timeout=timeout) as response:
+            self._check_headers(url, response.headers)
+            # read1 returns whatever has arrived instead of waiting for a full
+            # chunk, and each socket read is capped at the time left, so a
+            # server trickling bytes can't hold the download past total_timeout
+            connection = getattr(response.raw, "connection", None)
+            sock = getattr(connection, "sock", None)
+            chunks = []
+            size = 0
+            while True:
+                if self._total_timeout is not None:
+                    remaining = self._total_timeout - (self._clock.time() - started_at)
+                    if remaining <= 0:
+                        raise DownloadAbortedError(f"Download took longer than {self._total_timeout}s: {url}", "timeout")
+                    if sock is not None:
+                        sock.settimeout(remaining if self._read_timeout is None else min(remaining, self._read_timeout))
+                try:
+                    chunk = response.raw.read1(self._chunk_size, decode_content=True)
+                except Exception as e:
+                    if self._total_timeout is not None and self._clock.time() - started_at >= self._total_timeout:
+                        raise DownloadAbortedError(f"Download took longer than {self._total_timeout}s: {url}", "timeout") from e
+                    raise
+                if not chunk:
+                    break
+                size += len(chunk)
+                if self._max_bytes is not None and size > self._max_bytes:
+                    raise DownloadAbortedError(f"Body larger than {self._max_bytes} bytes: {url}", "too_large")
+                chunks.append(chunk)
+        return b"".join(chunks).decode()
+
+    def _check_headers(self, url, headers):
+        content_type = headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if self._content_types is not None and content_type != "" and content_type not in self._content_types:
+            raise DownloadAbortedError(f"Unexpected content type '{content_type}': {url}", "content_type")
+        content_length = headers.get("Content-Length")
+        if self._max_bytes is not None and content_length is not None and \
+           content_length.isdigit() and int(content_length) > self._max_bytes:
+            raise DownloadAbortedError(f"Body larger than {self._max_bytes} bytes ({content_length}): {url}", "too_large")
+
+    @classmethod
+    def parse(cls, content):
+        from lxml import etree
         parser = etree.HTMLParser()
         root = etree.fromstring(content, parser)
         return root
 
-    def _wait(self):
-        while self._last_request is not None and time.time() < self._last_request + self._request_delay:
-            time.sleep(0.1)
+    @classmethod
+    def iterparse(cls, content, tag):
+        # yields each `tag` element once it is complete; elements are cleared
+        # (with their already processed siblings) as soon as the consumer moves on
+        from lxml import etree
+        stream = io.BytesIO(content.encode())
+        for _, element in etree.iterparse(stream, events=("end",), tag=tag, html=True, recover=True):
+            yield element
+            element.clear(keep_tail=True)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    def _wait(self, url):
+        while self._last_request is not None and self._clock.time() < self._last_request + self._request_delay:
+            self._clock.sleep(0.1)
+        if self._robots is not None:
+            crawl_delay = self._robots.crawl_delay(url)
+            last_host_request = self._last_host_request.get(RobotsCache.host_of(url))
+            while last_host_request is not None and self._clock.time() < last_host_request + crawl_delay:
+                self._clock.sleep(0.1)
             
     
+class Selector(abc.ABC):
+    # Declared as a Page class attribute; compiled once when the page is registered
+    def __init__(self, expression, first=False):
+        self._expression = expression
+        self._first = first
+        self._compiled = None
+        self._name = None
+
+    def __set_name__(self, owner, name):
+        self._name = name
+
+    @property
+    def expression(self):
+        return self._expression
+
+    @abstractmethod
+    def _compile(self):
+        pass
+
+    def compile(self):
+        if self._compiled is None:
+            self._compiled = self._compile()
+        return self._compiled
+
+    def __call__(self, html):
+        result = self.compile()(html)
+        if self._first:
+            return result[0] if len(result) > 0 else None
+        return result
+
+
+class XPathSelector(Selector):
+    def _compile(self):
+        from lxml import etree
+        return etree.XPath(self._expression)
+
+
+class CSSSelector(Selector):
+    def _compile(self):
+        try:
+            from lxml.cssselect import CSSSelector as LxmlCSSSelector
+        except ImportError:
+            raise ImportError("CSS selectors require the cssselect package")
+        return LxmlCSSSelector(self._expression)
+
+
 class JSONSerializable(abc.ABC):
+    __slots__ = ()
+
     @abstractmethod
     def to_json(self):
         pass
@@ -103,14 +240,18 @@ class JSONSerializable(abc.ABC):
 
     
 class Item(JSONSerializable):
-    accepted_types = [int, float, str, bool, list, dict, tuple, type(None)]
+    __slots__ = ("_id", "_type", "_attribs", "_json")
+    accepted_types = frozenset([int, float, str, bool, list, dict, tuple, type(None)])
+    # item type -> [(attribs, unique)], turned into item_store indexes by ItemStore
+    _indexes = {}
     
     def __init__(self, id_, type_, attribs={}):
         self._id = id_
         self._type = type_
         self._attribs = {}
+        self._json = None
         for k, v in attribs.items():
-            if type(k) != str:
+            if type(k) is not str:
                 raise TypeError("Item attrib keys must be of type str")
             if type(v) not in self.accepted_types:
                 types = [ str(t) for t in self.accepted_types ]
@@ -128,30 +269,53 @@ class Item(JSONSerializable):
     def __str__(self):
         return "[" + self._id + "]" + f"<{self._type}>{{" + ','.join([ f"{k}:{self._attribs[k]}" for k in sorted(self._attribs.keys()) ]) + "}"
 
+    def __eq__(self, other):
+        return isinstance(other, Item) and self._id == other._id
+
+    def __hash__(self):
+        return hash(self._id)
+
     def to_json(self):
-        obj = {
-            "_type": self._type,
-        }
-        for key, value in self._attribs.items():
-            obj[key] = value
-        return obj
+        # items are immutable once created, so the serialization is computed once
+        if self._json is None:
+            obj = {
+                "_id": self._id,
+                "_type": self._type,
+            }
+            for key, value in self._attribs.items():
+                obj[key] = value
+            self._json = obj
+        return self._json
 
     @classmethod
     def from_json(cls, obj):
         attribs = { key: value for key, value in obj.items() if not key.startswith("_") }
         return cls(obj["_id"], obj["_type"], attribs)
 
+    @classmethod
+    def declare_index(cls, type_, attribs, unique=False):
+        # attribs: an attrib name, or a list of names / (name, direction) pairs
+        if isinstance(attribs, str):
+            attribs = [attribs]
+        attribs = tuple([ (a, 1) if isinstance(a, str) else tuple(a) for a in attribs ])
+        cls._indexes.setdefault(type_, [])
+        if (attribs, unique) not in cls._indexes[type_]:
+            cls._indexes[type_].append((attribs, unique))
+
     
 class Key(JSONSerializable):
+    __slots__ = ("_values", "_canonical")
+
     def __init__(self, **kwargs):
         if kwargs == {}:
             raise ValueError("Key must not be empty")
         if not Utils.are_all_scalar(kwargs):
             raise TypeError("All Key parameter values must be scalar")
         self._values = kwargs
+        self._canonical = None
 
     def __getattr__(self, name):
-        if name in self._values:
+        if not name.startswith("_") and name in self._values:
             return self._values[name]
         else:
             raise AttributeError(f"Keys have no attribute '{name}'")
@@ -159,6 +323,22 @@ class Key(JSONSerializable):
     def __str__(self):
         return "(" + ','.join([ f"{k}={self._values[k]}" for k in sorted(self._values.keys()) ]) + ")"
 
+    @classmethod
+    def canonical_json(cls, values):
+        return json.dumps(values, sort_keys=True, separators=(",", ":"))
+
+    @property
+    def canonical(self):
+        if self._canonical is None:
+            self._canonical = self.canonical_json(self._values)
+        return self._canonical
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and self.canonical == other.canonical
+
+    def __hash__(self):
+        return hash(self.canonical)
+
     def to_json(self):
         return self._values
 
@@ -168,30 +348,81 @@ class Key(JSONSerializable):
 
     
 class Page(JSONSerializable):
-    accepted_types = [int, float, str, bool, list, tuple, dict, type(None)]
+    # subclasses only drop the per-instance __dict__ if they declare slots as
+    # well: __slots__ = () (or the names of any attributes they set on self)
+    __slots__ = ("_key", "_attribs", "_json")
+    accepted_types = frozenset([int, float, str, bool, list, tuple, dict, type(None)])
+    adaptive_revisit = None
+    skip_unchanged = False
+    volatile_xpaths = []
+    max_concurrency = None
+    max_queued = None
+    crawl_weight = 1
+    dedup_content = False
+    priority = 0
+    iterparse_tag = None
+    parse_batch_size = 1000
     _registry = {}
     
     def __init__(self, key=None, **kwargs):
         self._key = key
         self._attribs = {}
+        self._json = None
         for key, value in kwargs.items():
             self[key] = value
 
     @classmethod
     def register_page(cls, page_name, page_cls):
+        page_cls.compile_selectors()
         cls._registry[page_name] = page_cls
 
+    @classmethod
+    def compile_selectors(cls):
+        for klass in cls.__mro__:
+            for name, value in vars(klass).items():
+                if isinstance(value, Selector):
+                    try:
+                        value.compile()
+                    except SyntaxError as e:
+                        raise ValueError(f"Invalid selector {cls.__name__}.{name} '{value.expression}': {e}")
+
+    def extract_links(self, html, selector):
+        base_url = self.url()
+        seen = set()
+        for href in selector(html):
+            url = urljoin(base_url, str(href).strip())
+            if url not in seen:
+                seen.add(url)
+                yield url
+
     @property
     def key(self):
         return self._key
 
+    @property
+    def identity(self):
+        key_str = self._key.canonical if self._key is not None else ""
+        return self.page_name + key_str
+
+    @classmethod
+    def json_identity(cls, obj):
+        key_str = Key.canonical_json(obj["key"]) if obj["key"] is not None else ""
+        return obj["page_name"] + key_str
+
+    def page_filter(self, prefix=""):
+        return {
+            prefix + "page_name": self.page_name,
+            prefix + "key": self._key.to_json() if self._key is not None else None,
+        }
+
     def __setitem__(self, key, value):
-        if type(key) != str:
+        if type(key) is not str:
             raise TypeError("Page attribute keys must be of type str")
         if type(value) not in self.accepted_types:
             types = [ str(t) for t in self.accepted_types ]
             raise TypeError(f"Page attribute values must be one of: {', '.join(types)}")
         self._attribs[key] = value
+        self._json = None
 
     def __getitem__(self, key):
         if key not in self._attribs.keys():
@@ -216,19 +447,35 @@ class Page(JSONSerializable):
 
     @abstractmethod
     def parse(self, html):
+        # returns a ParsingOutput, or yields Items and Pages as they are found.
+        # With iterparse_tag set, html is an iterator over the matching elements
         pass
 
+    def parse_content(self, content):
+        if self.iterparse_tag is not None:
+            return self.parse(HTTPDownloader.iterparse(content, self.iterparse_tag))
+        return self.parse(HTTPDownloader.parse(content))
+
     def __str__(self):
         key_str = str(self._key) if self._key is not None else ""
         return "<" + self.page_name + ">" + key_str
 
+    def __eq__(self, other):
+        return isinstance(other, Page) and self.identity == other.identity
+
+    def __hash__(self):
+        return hash(self.identity)
+
     def to_json(self):
-        return {
-            "page_name": self.page_name,
-            "key": self.key.to_json() if self.key is not None else None,
-            "attributes": self._attribs,
-            "url": self.url(),
-        }
+        # cached until an attribute changes; callers must not modify the result
+        if self._json is None:
+            self._json = {
+                "page_name": self.page_name,
+                "key": self.key.to_json() if self.key is not None else None,
+                "attributes": self._attribs,
+                "url": self.url(),
+            }
+        return self._json
 
     @classmethod
     def from_json(cls, obj):
@@ -240,13 +487,16 @@ class Page(JSONSerializable):
 
     
 class PageRequest(JSONSerializable):
-    def __init__(self, page, last_updated_at, next_update_at, id_=None):
+    __slots__ = ("_page", "_last_updated_at", "_next_update_at", "_id", "_priority")
+
+    def __init__(self, page, last_updated_at, next_update_at, id_=None, priority=None):
         if next_update_at is None or (last_updated_at is not None and next_update_at <= last_updated_at):
             raise ValueError("next_update_at must contain a value greater than last_updated_at")
         self._page = page
         self._last_updated_at = last_updated_at
         self._next_update_at = next_update_at
         self._id = id_
+        self._priority = priority
 
     @property
     def id(self):
@@ -264,6 +514,11 @@ class PageRequest(JSONSerializable):
     def next_update_at(self):
         return self._next_update_at
 
+    @property
+    def priority(self):
+        # higher is served first among due requests; defaults to the page's
+        return self._priority if self._priority is not None else self._page.priority
+
     def __str__(self):
         return f"{str(self.page)}(Update:{self._next_update_at.strftime('%Y-%m-%d_%H:%M:%S')})"
 
@@ -272,6 +527,7 @@ class PageRequest(JSONSerializable):
             "page": self.page.to_json(),
             "last_updated_at": self.last_updated_at,
             "next_update_at": self.next_update_at,
+            "priority": self.priority,
         }
 
     @classmethod
@@ -279,115 +535,883 @@ class PageRequest(JSONSerializable):
         page = Page.from_json(obj["page"])
         last_updated_at = obj["last_updated_at"]
         next_update_at = obj["next_update_at"]
-        return cls(page, last_updated_at, next_update_at, id_=id_)
+        return cls(page, last_updated_at, next_update_at, id_=id_, priority=obj.get("priority"))
+
+
+class CrawlStats:
+    statuses = ["pending", "processing", "completed", "failed"]
+
+    def __init__(self, db, clock=None):
+        self._clock = clock if clock is not None else system_clock
+        self._db = db
+        self._cs = db.crawl_stats
+        self._ct = db.crawl_throughput
+        self._counts = {}
+        self._buckets = {}
+        self._batch_depth = 0
+
+    @classmethod
+    def minute_of(cls, dt):
+        return dt.replace(second=0, microsecond=0)
+
+    @contextmanager
+    def batch(self):
+        # increments made inside are summed and written together on exit
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.flush()
+
+    @classmethod
+    def _add(cls, totals, key, increments):
+        total = totals.setdefault(key, {})
+        for field, n in increments.items():
+            total[field] = total.get(field, 0) + n
+
+    def _update(self, page_name, counts, bucket):
+        if len(counts) > 0:
+            self._add(self._counts, page_name, counts)
+        if len(bucket) > 0:
+            self._add(self._buckets, self.minute_of(self._clock.now()), bucket)
+        if self._batch_depth == 0:
+            self.flush()
+
+    def flush(self):
+        from pymongo import UpdateOne
+        for collection, totals in [(self._cs, self._counts), (self._ct, self._buckets)]:
+            operations = []
+            for _id, increments in totals.items():
+                increments = { field: n for field, n in increments.items() if n != 0 }
+                if len(increments) > 0:
+                    operations.append(UpdateOne({"_id": _id}, {"$inc": increments}, upsert=True))
+            if len(operations) > 0:
+                collection.bulk_write(operations, ordered=False)
+            totals.clear()
+
+    def transition(self, page_name, from_status, to_status, n=1):
+        if n == 0:
+            return
+        counts = {}
+        bucket = {}
+        if from_status is not None:
+            counts[from_status] = -n
+        if to_status is not None:
+            counts[to_status] = counts.get(to_status, 0) + n
+        if from_status is None and to_status == "pending":
+            bucket["enqueued"] = n
+        if to_status in ("completed", "failed"):
+            bucket[to_status] = n
+        pending_delta = int(to_status == "pending") - int(from_status == "pending")
+        if pending_delta != 0:
+            bucket["pending_delta"] = pending_delta * n
+        self._update(page_name, counts, bucket)
+
+    def items_changed(self, page_name, inserted, deleted):
+        counts = {"items": inserted - deleted} if inserted != deleted else {}
+        bucket = {"items": inserted} if inserted > 0 else {}
+        self._update(page_name, counts, bucket)
+
+    def is_empty(self):
+        return self._cs.count_documents({}, limit=1) == 0
+
+    def rebuild(self):
+        # one-off full recount, for databases created before the rollups existed
+        counts = {}
+        for collection in [self._db.request_queue, self._db.request_history]:
+            for row in collection.aggregate([
+                    {"$group": {"_id": {"page_name": "$payload.page.page_name", "status": "$status"}, "n": {"$sum": 1}}},
+            ], allowDiskUse=True):
+                page_counts = counts.setdefault(row["_id"]["page_name"], {})
+                page_counts[row["_id"]["status"]] = page_counts.get(row["_id"]["status"], 0) + row["n"]
+        for row in self._db.item_store.aggregate([
+                {"$group": {"_id": "$page.page_name", "n": {"$sum": 1}}},
+        ], allowDiskUse=True):
+            counts.setdefault(row["_id"], {})["items"] = row["n"]
+        for page_name, page_counts in counts.items():
+            doc = { status: page_counts.get(status, 0) for status in self.statuses + ["items"] }
+            self._cs.replace_one({"_id": page_name}, doc, upsert=True)
+
+    def page_names(self):
+        return sorted([ doc["_id"] for doc in self._cs.find({}, {"_id": 1}) ])
+
+    def counts(self):
+        return list(self._cs.find().sort("_id", 1))
+
+    def throughput(self, since):
+        return list(self._ct.find({"_id": {"$gte": self.minute_of(since)}}).sort("_id", 1))
 
 
 class ItemStore:
-    def __init__(self, db):
+    def __init__(self, db, clock=None, change_feed=False, feed_ttl=None):
+        self._clock = clock if clock is not None else system_clock
         self._is = db.item_store
+        self._stats = CrawlStats(db, clock)
+        # change_feed: log inserted, updated and deleted items to an ItemFeed
+        self._feed = ItemFeed(db, feed_ttl, clock) if change_feed else None
         self._create_indices()
 
     def _create_indices(self):
         # @: create all indices
-        pass
+        self._is.create_index("parsed_at")
+        self._is.create_index("item._type")
+        self._is.create_index(["page.page_name", "page.key", "item._id"])
+        self._create_item_indices()
+
+    def _create_item_indices(self):
+        # declared indexes lead with item._type, so types indexing the same attribs share
+        # them; unique ones only cover their own type, or items of other types lacking
+        # the attribs would collide on null
+        for type_, indexes in Item._indexes.items():
+            for attribs, unique in indexes:
+                keys = [("item._type", 1)] + [ ("item." + attrib, direction) for attrib, direction in attribs ]
+                if unique:
+                    name = "_".join([f"{type_}_unique"] + [ f"{attrib}_{direction}" for attrib, direction in attribs ])
+                    self._is.create_index(keys, name=name, unique=True,
+                                          partialFilterExpression={"item._type": type_})
+                else:
+                    self._is.create_index(keys)
+
+    @classmethod
+    def field(cls, name):
+        # item attribs by name (including _id and _type); parsed_at and page.* address
+        # the stored document around the item
+        if name == "parsed_at" or name.startswith("page."):
+            return name
+        return "item." + name
+
+    @classmethod
+    def _value_at(cls, doc, field):
+        for part in field.split("."):
+            if not isinstance(doc, dict):
+                return None
+            doc = doc.get(part)
+        return doc
+
+    @classmethod
+    def encode_cursor(cls, values):
+        from bson import json_util
+        import base64
+        return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+    @classmethod
+    def decode_cursor(cls, cursor):
+        from bson import json_util
+        import base64
+        return json_util.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+
+    @classmethod
+    def _after_query(cls, sort, values):
+        # keyset pagination: documents sorting strictly after values. Nulls sort first,
+        # but $gt/$lt never match them, so they are asked for explicitly.
+        clauses = []
+        for i, (field, direction) in enumerate(sort):
+            clause = { f: v for (f, _), v in zip(sort[:i], values[:i]) }
+            if values[i] is None:
+                if direction < 0:
+                    continue
+                clause[field] = {"$ne": None}
+            elif direction > 0:
+                clause[field] = {"$gt": values[i]}
+            else:
+                clause["$or"] = [{field: {"$lt": values[i]}}, {field: None}]
+            clauses.append(clause)
+        return {"$or": clauses} if len(clauses) > 0 else {"_id": {"$exists": False}}
+
+    def find_items(self, type_=None, filter={}, sort=[], projection=None, limit=100, cursor=None):
+        # filter: {attrib: value or {operator: value}}; sort: attrib names or (name, direction);
+        # projection: attribs to load, all of them when None. Returns (items, cursor), where
+        # cursor fetches the next batch and is None after the last one.
+        query = { self.field(name): value for name, value in filter.items() }
+        if type_ is not None:
+            query["item._type"] = type_
+        sort = [ (self.field(s), 1) if isinstance(s, str) else (self.field(s[0]), s[1]) for s in sort ]
+        sort.append(("_id", 1))
+        if cursor is not None:
+            query = {"$and": [query, self._after_query(sort, self.decode_cursor(cursor))]}
+        fields = None
+        if projection is not None:
+            fields = { field: 1 for field in ["item._id", "item._type"] + [ self.field(name) for name in projection ] }
+            fields.update({ field: 1 for field, _ in sort })
+        docs = list(self._is.find(query, fields).sort(sort).limit(limit + 1))
+        next_cursor = None
+        if len(docs) > limit:
+            docs = docs[:limit]
+            next_cursor = self.encode_cursor([ self._value_at(docs[-1], field) for field, _ in sort ])
+        items = []
+        for doc in docs:
+            obj = doc["item"]
+            if projection is not None:
+                obj = { key: value for key, value in obj.items() if key.startswith("_") or key in projection }
+            items.append(Item.from_json(obj))
+        return items, next_cursor
+
+    def _stored_items(self, pages, item_ids=None):
+        # {page identity: {item id: item json}} of the items currently stored
+        # for pages, only those with item_ids if given
+        stored = { page.identity: {} for page in pages }
+        if len(pages) == 0:
+            return stored
+        query = {"$or": [ page.page_filter("page.") for page in pages ]}
+        if item_ids is not None:
+            query["item._id"] = {"$in": list(item_ids)}
+        for doc in self._is.find(query, {"item": 1, "page.page_name": 1, "page.key": 1}):
+            stored[Page.json_identity(doc["page"])][doc["item"]["_id"]] = doc["item"]
+        return stored
+
+    @classmethod
+    def new_parse_id(cls):
+        from bson import ObjectId
+        return ObjectId()
 
     def set_items(self, items, page):
-        self._is.delete_many({
-            "page.page_name": page.to_json()["page_name"],
-            "page.key": page.to_json()["key"],
+        self.replace_items([(page, items)])
+
+    def add_items(self, items, page):
+        self.write_items([(page, items, self.new_parse_id(), self._clock.now())])
+
+    def replace_items(self, page_items):
+        # set_items for many pages: their items are written by one parse, and
+        # then the ones it did not yield are swept
+        parse_id = self.new_parse_id()
+        parsed_at = self._clock.now()
+        self.write_items([ (page, items, parse_id, parsed_at) for page, items in page_items ])
+        self.sweep_items([ (page, parse_id) for page, items in page_items ])
+
+    def write_items(self, parsed):
+        # parsed: [(page, items, parse_id, parsed_at)]. Items are upserted by
+        # page and item id with one unordered bulk write per page_name, and
+        # tagged with the parse that wrote them, so that sweep_items can
+        # remove the stored items a parse did not yield once it finished.
+        # Writing the same items again only retags them. With a change feed,
+        # the written items are diffed against their stored versions.
+        from pymongo import UpdateOne
+        from pymongo.errors import BulkWriteError
+        by_page_name = {}
+        for page, items, parse_id, parsed_at in parsed:
+            if len(items) > 0:
+                by_page_name.setdefault(page.page_name, []).append((page, items, parse_id, parsed_at))
+        for page_name, page_name_items in by_page_name.items():
+            stored = None
+            if self._feed is not None:
+                stored = self._stored_items(
+                    [ page for page, _, _, _ in page_name_items ],
+                    { item.id for _, items, _, _ in page_name_items for item in items })
+            operations = []
+            written = []
+            for page, items, parse_id, parsed_at in page_name_items:
+                written.extend([ (page.identity, item.id) for item in items ])
+                page_json = page.to_json()
+                page_filter = page.page_filter("page.")
+                operations.extend([ UpdateOne(
+                    {**page_filter, "item._id": item.id},
+                    {"$set": {
+                        "item": item.to_json(),
+                        "page": page_json,
+                        "parsed_at": parsed_at,
+                        "parse_id": parse_id,
+                    }},
+                    upsert=True,
+                ) for item in items ])
+            failed = set()
+            try:
+                n_upserted = self._is.bulk_write(operations, ordered=False).upserted_count
+            except BulkWriteError as e:
+                # items breaking a unique index (index_items) are dropped
+                # rather than retried; any other error is raised
+                if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                    raise
+                for error in e.details["writeErrors"]:
+                    logging.warning(f"Item dropped, {error['errmsg']}")
+                    failed.add(written[error["index"]])
+                n_upserted = e.details["nUpserted"]
+            self._stats.items_changed(page_name, n_upserted, 0)
+            if self._feed is not None:
+                for page, items, _, _ in page_name_items:
+                    # only inserts and updates: deletes are left to sweep_items
+                    new_items = { item.id: item.to_json() for item in items if (page.identity, item.id) not in failed }
+                    old_items = { item_id: item_json for item_id, item_json in stored[page.identity].items()
+                                  if item_id in new_items }
+                    self._feed.record(page, ItemFeed.diff(old_items, new_items))
+
+    def sweep_items(self, parsed):
+        # parsed: [(page, parse_id)]; deletes the items of each page that its
+        # parse did not write
+        for page, parse_id in parsed:
+            query = {**page.page_filter("page."), "parse_id": {"$ne": parse_id}}
+            deleted_items = []
+            if self._feed is not None:
+                deleted_items = [ doc["item"] for doc in self._is.find(query, {"item": 1}) ]
+            deleted = self._is.delete_many(query).deleted_count
+            self._stats.items_changed(page.page_name, 0, deleted)
+            if self._feed is not None:
+                self._feed.record(page, [ ("delete", item_json) for item_json in deleted_items ])
+
+
+class ChangeTracker:
+    def __init__(self, db, clock=None):
+        self._clock = clock if clock is not None else system_clock
+        self._pc = db.page_changes
+        self._pcc = db.page_contents
+        self._create_indices()
+
+    def _create_indices(self):
+        self._pc.create_index([("page_name", 1), ("key", 1)], unique=True)
+        self._pcc.create_index([("_id.page_name", 1), ("key", 1)])
+
+    @classmethod
+    def content_hash(cls, content, volatile_xpaths=[]):
+        if len(volatile_xpaths) > 0:
+            from lxml import etree
+            root = HTTPDownloader.parse(content)
+            for xpath in volatile_xpaths:
+                for element in root.xpath(xpath):
+                    if isinstance(element, etree._Element):
+                        element.clear(keep_tail=True)
+            content = etree.tostring(root, encoding="unicode")
+        # without volatile parts, the same hash the cache stores the body under
+        return CacheManager.body_hash(content)
+
+    def claim_content(self, page, content_hash):
+        # the first page of its page_name fetched with a given body owns it,
+        # until the owner is fetched with another body: then a duplicate still
+        # serving the old body takes it over. Returns the owner's page_filter
+        # when that is another page
+        from pymongo import ReturnDocument
+        key = page.page_filter()["key"]
+        self._pcc.delete_many({
+            "_id.page_name": page.page_name,
+            "_id.content_hash": {"$ne": content_hash},
+            "key": key,
         })
-        item_jsons = [ {
-            "item": item.to_json(),
-            "page": page.to_json(),
-            "parsed_at": datetime.now(),
-        } for item in items ]
-        self._is.insert_many(item_jsons)
+        owner = self._pcc.find_one_and_update(
+            {"_id": {"page_name": page.page_name, "content_hash": content_hash}},
+            {"$setOnInsert": {"key": key, "first_seen_at": self._clock.now()}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        owner = {"page_name": page.page_name, "key": owner["key"]}
+        return owner if Page.json_identity(owner) != page.identity else None
+
+    def get_state(self, page):
+        return self._pc.find_one(page.page_filter())
+
+    def record_fetch(self, page, state, content_hash, fetched_at):
+        state = self.updated_state(page, state, content_hash, fetched_at)
+        self.save_states([state])
+        return state
+
+    @classmethod
+    def updated_state(cls, page, state, content_hash, fetched_at):
+        if state is None:
+            state = {
+                **page.page_filter(),
+                "n_checks": 0,
+                "n_changes": 0,
+                "observed_seconds": 0.0,
+            }
+        else:
+            state = dict(state)
+            state["n_checks"] += 1
+            state["n_changes"] += int(state["content_hash"] != content_hash)
+            state["observed_seconds"] += (fetched_at - state["last_fetched_at"]).total_seconds()
+        state["content_hash"] = content_hash
+        state["last_fetched_at"] = fetched_at
+        return state
+
+    def save_states(self, states):
+        from pymongo import ReplaceOne
+        if len(states) == 0:
+            return
+        self._pc.bulk_write([ ReplaceOne(
+            {
+                "page_name": state["page_name"],
+                "key": state["key"],
+            },
+            state,
+            upsert=True,
+        ) for state in states ], ordered=False)
+
+
+class AdaptiveScheduler:
+    def __init__(self, min_interval, max_interval):
+        if min_interval > max_interval:
+            raise ValueError("min_interval must not be greater than max_interval")
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+
+    @classmethod
+    def estimate_change_rate(cls, n_checks, n_changes, observed_seconds):
+        # Poisson estimator for regularly spaced checks (Cho & Garcia-Molina),
+        # in changes per second
+        if n_checks == 0 or observed_seconds <= 0:
+            return None
+        mean_interval = observed_seconds / n_checks
+        return -math.log((n_checks - n_changes + 0.5) / (n_checks + 0.5)) / mean_interval
+
+    def next_interval(self, state):
+        rate = None
+        if state is not None:
+            rate = self.estimate_change_rate(state["n_checks"], state["n_changes"], state["observed_seconds"])
+        if rate is None:
+            return self._min_interval
+        if rate == 0:
+            return self._max_interval
+        interval = timedelta(seconds=1 / rate)
+        return max(self._min_interval, min(self._max_interval, interval))
+
+    def next_update_at(self, state, last_updated_at):
+        return last_updated_at + self.next_interval(state)
+
 
 class RequestQueue:
-    def __init__(self, db):
+    # request_queue only holds actionable (pending and processing) requests;
+    # completed and failed ones are moved to request_history, where completed
+    # entries expire after history_ttl seconds if given.
+    # Due requests are served by priority, then due time; pending requests
+    # overdue by more than aging_interval seconds gain one priority level per
+    # interval so low priorities are not starved.
+    # With n_shards, requests are spread over host shards and each worker
+    # only leases from the shards assigned to it among the live workers
+    # (all workers sharing the queue must use the same n_shards).
+    # Requests processing for longer than max_processing_time seconds (their
+    # worker is assumed dead) are put back to pending.
+    # @: max_retries configurable
+    max_retries = 2
+
+    def __init__(self, db, max_queued=None, fair_dequeue=False, history_ttl=None, aging_interval=3600,
+                 n_shards=None, worker_id=None, worker_timeout=60, max_processing_time=600,
+                 maintenance_interval=10, clock=None):
+        self._clock = clock if clock is not None else system_clock
+        self._max_processing_time = max_processing_time
+        # stale and failed requests are looked for every maintenance_interval seconds
+        self._maintenance_interval = maintenance_interval
+        self._last_maintenance_at = None
         self._rq = db.request_queue
+        self._rh = db.request_history
         self._ap = db.archived_pages
+        self._history_ttl = history_ttl
+        self._aging_interval = aging_interval
+        self._last_aged_at = None
+        self._max_queued = max_queued
+        self._fair_dequeue = fair_dequeue
+        self._dequeue_passes = {}
+        self._n_shards = n_shards
+        self._worker_id = worker_id if worker_id is not None else f"{socket.gethostname()}:{os.getpid()}"
+        self._worker_timeout = worker_timeout
+        self._workers = db.crawl_workers
+        self._shards = []
+        self._last_heartbeat_at = None
+        self._heartbeat_stop = None
+        self._heartbeat_thread = None
+        self._checkpoints = db.crawl_checkpoints
+        self._stats = CrawlStats(db, clock)
         self._create_indices()
 
     def _create_indices(self):
         # @: create all indices
         self._rq.create_index("payload.next_update_at")
+        self._rq.create_index([("status", 1), ("payload.priority", -1), ("payload.next_update_at", 1)])
         self._rq.create_index(["payload.page.page_name", "payload.page.key"])
-        self._ap.create_index(["payload.page_name", "payload.key"])
-        
+        self._rq.create_index(["status", "payload.page.page_name"])
+        self._rq.create_index("status_updated_at")
+        self._rq.create_index([("status", 1), ("retries", 1)])
+        self._rq.create_index("rescheduled_from", unique=True,
+                              partialFilterExpression={"rescheduled_from": {"$exists": True}})
+        if self._n_shards is not None:
+            self._rq.create_index([("status", 1), ("shard", 1), ("payload.priority", -1), ("payload.next_update_at", 1)])
+        self._rh.create_index(["payload.page.page_name", "payload.page.key"])
+        self._rh.create_index(["status", "payload.page.page_name"])
+        if self._history_ttl is not None:
+            self._rh.create_index(
+                "status_updated_at",
+                expireAfterSeconds=self._history_ttl,
+                partialFilterExpression={"status": "completed"},
+            )
+        else:
+            self._rh.create_index("status_updated_at")
+        self._ap.create_index(["page_name", "key"])
+
+    def _count_status(self, status, page_name=None, limit=0):
+        query = {"status": status}
+        if page_name is not None:
+            query["payload.page.page_name"] = page_name
+        return self._rq.count_documents(query, limit=limit)
+
+    def _within_budget(self, page):
+        if self._max_queued is not None and \
+           self._count_status("pending", limit=self._max_queued) >= self._max_queued:
+            logging.info(f"Request queue budget exhausted, {page} not added")
+            return False
+        if page.max_queued is not None and \
+           self._count_status("pending", page.page_name, limit=page.max_queued) >= page.max_queued:
+            logging.info(f"Queue budget for '{page.page_name}' exhausted, {page} not added")
+            return False
+        return True
+
     def add_request(self, request, force=False):
-        if force or self._rq.count_documents({
-                "status": {"$in": ["pending", "processing", "failed"]},
-                "payload.page.page_name": request.page.to_json()["page_name"],
-                "payload.page.key": request.page.to_json()["key"],
-        }, limit=1) == 0:
-            self._rq.insert_one({
-                "payload": request.to_json(),
-                "status": "pending",
-                "created_at": datetime.now(),
-                "status_updated_at": datetime.now(),
-                "processing_started_at": None,
-                "retries": 0,
-            })
+        # reschedules (force) bypass the budgets, otherwise the page would be lost
+        if not force and not self._within_budget(request.page):
+            return False
+        if force or not self._is_queued(request.page):
+            self._rq.insert_one(self._request_doc(request))
+            self._stats.transition(request.page.page_name, None, "pending")
             return True
         return False
+
+    def _is_queued(self, page):
+        # failed pages are not requested again
+        query = page.page_filter("payload.page.")
+        return self._rq.count_documents({"status": {"$in": ["pending", "processing"]}, **query}, limit=1) > 0 or \
+            self._rh.count_documents({"status": "failed", **query}, limit=1) > 0
+
+    def _request_doc(self, request):
+        doc = {
+            "payload": request.to_json(),
+            "status": "pending",
+            "created_at": self._clock.now(),
+            "status_updated_at": self._clock.now(),
+            "processing_started_at": None,
+            "retries": 0,
+        }
+        if self._n_shards is not None:
+            doc["shard"] = self.shard_of(doc["payload"]["page"]["url"], self._n_shards)
+        return doc
+
+    # what shard_of hashes, stored with the shard count to detect changes
+    shard_key = "hostname"
+
+    @classmethod
+    def stored_shards(cls, db):
+        # shard count the crawlers sharing db last migrated to, None if not sharded
+        sharding = db.crawl_checkpoints.find_one({"_id": "request_shards"})
+        return sharding["n_shards"] if sharding is not None else None
+
+    @classmethod
+    def shard_of(cls, url, n_shards):
+        # by hostname alone, so that http, https and any port share a shard
+        host = urlsplit(url).hostname or ""
+        return int(hashlib.md5(host.encode()).hexdigest(), 16) % n_shards
+
+    @classmethod
+    def assign_shards(cls, worker_ids, n_shards):
+        # rendezvous hashing: each shard goes to the worker scoring highest on
+        # it, so a worker joining or leaving only moves its own share of shards
+        assignment = { worker_id: [] for worker_id in worker_ids }
+        for shard in range(n_shards):
+            owner = max(worker_ids, key=lambda worker_id: hashlib.md5(f"{worker_id}:{shard}".encode()).hexdigest())
+            assignment[owner].append(shard)
+        return assignment
+
+    @property
+    def shards(self):
+        return self._shards
+
+    def _heartbeat(self):
+        # re-reads the live workers, rebalancing shards when they change
+        now = self._clock.now()
+        if self._last_heartbeat_at is not None and \
+           now < self._last_heartbeat_at + timedelta(seconds=self._worker_timeout / 3):
+            return
+        self._last_heartbeat_at = now
+        self._workers.update_one({"_id": self._worker_id}, {"$set": {"heartbeat_at": now}}, upsert=True)
+        live_workers = [ worker["_id"] for worker in self._workers.find(
+            {"heartbeat_at": {"$gte": now - timedelta(seconds=self._worker_timeout)}},
+            {"_id": 1},
+        ) ]
+        shards = self.assign_shards(live_workers, self._n_shards)[self._worker_id]
+        if shards != self._shards:
+            logging.info(f"Worker {self._worker_id} now serves {len(shards)} of {self._n_shards} shards ({len(live_workers)} live workers)")
+            self._shards = shards
+            self._workers.update_one({"_id": self._worker_id}, {"$set": {"shards": shards}})
+
+    def start_heartbeat(self):
+        # a background thread keeps this worker alive while it is busy with a
+        # request longer than worker_timeout; shards are still rebalanced
+        # from the lease loop
+        if self._n_shards is None or self._heartbeat_thread is not None:
+            return
+        stop = threading.Event()
+        def beat():
+            while not stop.wait(self._worker_timeout / 3):
+                try:
+                    self._workers.update_one({"_id": self._worker_id}, {"$set": {"heartbeat_at": self._clock.now()}}, upsert=True)
+                except Exception:
+                    logging.exception(f"Heartbeat of worker {self._worker_id} failed")
+        self._heartbeat_stop = stop
+        self._heartbeat_thread = threading.Thread(target=beat, name="syncrawl-heartbeat", daemon=True)
+        self._heartbeat_thread.start()
+
+    def leave(self):
+        # lets the remaining workers take over this worker's shards right away
+        if self._heartbeat_thread is not None:
+            self._heartbeat_stop.set()
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+        if self._n_shards is not None:
+            self._workers.delete_one({"_id": self._worker_id})
+            self._last_heartbeat_at = None
+            self._shards = []
+
+    def migrate_shards(self, batch_size=1000):
+        # requests queued before sharding was enabled have no shard yet, and
+        # all of them move when the number of shards or the shard key changed
+        # (or is unknown)
+        from pymongo import UpdateOne
+        if self._n_shards is None:
+            return
+        sharding = self._checkpoints.find_one({"_id": "request_shards"})
+        query = {}
+        if sharding is not None and sharding["n_shards"] == self._n_shards and \
+           sharding.get("shard_key") == self.shard_key:
+            query = {"shard": {"$exists": False}}
+        n_migrated = 0
+        updates = []
+        def write():
+            nonlocal n_migrated, updates
+            if len(updates) > 0:
+                self._rq.bulk_write(updates, ordered=False)
+                n_migrated += len(updates)
+                updates = []
+        for doc in self._rq.find(query, {"payload.page.url": 1}).sort("_id", 1).batch_size(batch_size):
+            updates.append(UpdateOne(
+                {"_id": doc["_id"]},
+                {"$set": {"shard": self.shard_of(doc["payload"]["page"]["url"], self._n_shards)}},
+            ))
+            if len(updates) >= batch_size:
+                write()
+        write()
+        self._checkpoints.replace_one({"_id": "request_shards"},
+                                      {"n_shards": self._n_shards, "shard_key": self.shard_key}, upsert=True)
+        if n_migrated > 0:
+            logging.info(f"{n_migrated} queued requests assigned to {self._n_shards} host shards")
+
+    def add_requests(self, requests, force=False, budget=True):
+        # bulk version of add_request: one query to find the pages already
+        # queued, one unordered insert for the rest. budget=False still skips
+        # the pages already queued but ignores the budgets (root pages)
+        if len(requests) == 0:
+            return 0
+        queued = set()
+        if not force:
+            page_filters = [ request.page.page_filter("payload.page.") for request in requests ]
+            for collection, statuses in [(self._rq, ["pending", "processing"]), (self._rh, ["failed"])]:
+                for request_json in collection.find(
+                        {
+                            "status": {"$in": statuses},
+                            "$or": page_filters,
+                        },
+                        {"payload.page.page_name": 1, "payload.page.key": 1},
+                ):
+                    queued.add(Page.json_identity(request_json["payload"]["page"]))
+        global_left = None
+        budget = budget and not force
+        if budget and self._max_queued is not None:
+            global_left = self._max_queued - self._count_status("pending", limit=self._max_queued)
+        page_left = {}
+        docs = []
+        for request in requests:
+            page = request.page
+            if page.identity in queued:
+                continue
+            queued.add(page.identity)
+            if page.page_name not in page_left:
+                page_left[page.page_name] = None
+                if budget and page.max_queued is not None:
+                    page_left[page.page_name] = page.max_queued - self._count_status("pending", page.page_name, limit=page.max_queued)
+            if (global_left is not None and global_left <= 0) or \
+               (page_left[page.page_name] is not None and page_left[page.page_name] <= 0):
+                continue
+            if global_left is not None:
+                global_left -= 1
+            if page_left[page.page_name] is not None:
+                page_left[page.page_name] -= 1
+            docs.append(self._request_doc(request))
+        if len(docs) > 0:
+            self._rq.insert_many(docs, ordered=False)
+            added = {}
+            for doc in docs:
+                page_name = doc["payload"]["page"]["page_name"]
+                added[page_name] = added.get(page_name, 0) + 1
+            with self._stats.batch():
+                for page_name, n in added.items():
+                    self._stats.transition(page_name, None, "pending", n)
+        return len(docs)
     
+    def reschedule_requests(self, reschedules):
+        # reschedules: [(id of the ended request, its next request)]. They
+        # bypass the budgets, and are upserted by the request they follow,
+        # so writing them twice still queues each page once
+        from pymongo import UpdateOne
+        if len(reschedules) == 0:
+            return 0
+        operations = []
+        for rescheduled_from, request in reschedules:
+            operations.append(UpdateOne(
+                {"rescheduled_from": rescheduled_from},
+                {"$setOnInsert": self._request_doc(request)},
+                upsert=True,
+            ))
+        result = self._rq.bulk_write(operations, ordered=False)
+        added = {}
+        for i in result.upserted_ids:
+            page_name = reschedules[i][1].page.page_name
+            added[page_name] = added.get(page_name, 0) + 1
+        with self._stats.batch():
+            for page_name, n in added.items():
+                self._stats.transition(page_name, None, "pending", n)
+        return result.upserted_count
+
     def end_request(self, request):
-        # @: max_retries configurable
-        max_retries = 2
-        self._rq.update_one(
+        self.end_requests([request])
+
+    def end_requests(self, requests):
+        if len(requests) == 0:
+            return
+        def complete(doc):
+            doc["status"] = "completed"
+            doc["status_updated_at"] = self._clock.now()
+            doc["payload"]["next_update_at"] = None
+        self._move_to_history(
             {
-                "_id": request.id,
+                "_id": {"$in": [ request.id for request in requests ]},
                 "status": "processing",
-                "payload.page.page_name": request.page.to_json()["page_name"],
-                "payload.page.key": request.page.to_json()["key"],
-            },
-            {
-                "$set": {
-                    "status": "completed",
-                    "status_updated_at": datetime.now(),
-                    "payload.next_update_at": None,
-                },
             },
+            complete,
         )
 
-    def fail_request(self, request, error_msg, traceback_msg, force=False):
+    def fail_request(self, request, error_msg, traceback_msg, force=False, error_reason=None):
         # @: use id to select the request in the DB
-        self._rq.update_one(
-            {
-                "_id": request.id,
-                "status": "processing",
-                "payload.page.page_name": request.page.to_json()["page_name"],
-                "payload.page.key": request.page.to_json()["key"],
-            },
+        query = {
+            "_id": request.id,
+            "status": "processing",
+            **request.page.page_filter("payload.page."),
+        }
+        if force:
+            def fail(doc):
+                doc["status"] = "failed"
+                doc["status_updated_at"] = self._clock.now()
+                doc["error_msg"] = error_msg
+                doc["error_traceback"] = traceback_msg
+                doc["error_reason"] = error_reason
+                doc["retries"] += 1
+            self._move_to_history(query, fail)
+            return
+        result = self._rq.update_one(
+            query,
             {
                 "$set": {
-                    "status": ("failed" if force else "pending"),
-                    "status_updated_at": datetime.now(),
+                    "status": "pending",
+                    "status_updated_at": self._clock.now(),
                     "error_msg": error_msg,
                     "error_traceback": traceback_msg,
+                    "error_reason": error_reason,
                 },
                 "$inc": {"retries": 1},
             },
         )
+        self._stats.transition(request.page.page_name, "processing", "pending", result.modified_count)
+
+    def _move_to_history(self, query, update=None, batch_size=1000):
+        # finished requests leave the live queue; the history copy is written
+        # first (idempotently) so a crash in between cannot lose it. Only the
+        # requests this call deletes are counted, as another worker may be
+        # moving the same ones.
+        from pymongo import ReplaceOne
+        n_moved = 0
+        with self._stats.batch():
+            while True:
+                docs = list(self._rq.find(query).limit(batch_size))
+                if len(docs) == 0:
+                    return n_moved
+                transitions = {}
+                for doc in docs:
+                    from_status = doc["status"]
+                    if update is not None:
+                        update(doc)
+                    transition = (doc["payload"]["page"]["page_name"], from_status, doc["status"])
+                    transitions.setdefault(transition, []).append(doc["_id"])
+                self._rh.bulk_write([ ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in docs ], ordered=False)
+                for (page_name, from_status, to_status), ids in transitions.items():
+                    deleted = self._rq.delete_many({"_id": {"$in": ids}, "status": from_status}).deleted_count
+                    if from_status != to_status:
+                        self._stats.transition(page_name, from_status, to_status, deleted)
+                    n_moved += deleted
+
+    def migrate_priorities(self):
+        # requests queued before priorities existed would sort after all others
+        result = self._rq.update_many({"payload.priority": {"$exists": False}}, {"$set": {"payload.priority": 0}})
+        if result.modified_count > 0:
+            logging.info(f"{result.modified_count} queued requests given the default priority")
+
+    def _age_requests(self):
+        if self._aging_interval is None:
+            return
+        now = self._clock.now()
+        if self._last_aged_at is not None and now < self._last_aged_at + timedelta(seconds=self._aging_interval):
+            return
+        self._last_aged_at = now
+        # the queue is shared, so only the first worker to claim an interval ages it
+        from pymongo.errors import DuplicateKeyError
+        try:
+            self._checkpoints.find_one_and_update(
+                {"_id": "request_aging", "aged_at": {"$lte": now - timedelta(seconds=self._aging_interval)}},
+                {"$set": {"aged_at": now}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return
+        self._rq.update_many(
+            {
+                "status": "pending",
+                "payload.next_update_at": {"$lte": now - timedelta(seconds=self._aging_interval)},
+            },
+            {"$inc": {"payload.priority": 1}},
+        )
+
+    def migrate_history(self):
+        # databases created before the split kept finished requests in the queue
+        n_moved = self._move_to_history({"status": {"$in": ["completed", "failed"]}})
+        if n_moved > 0:
+            logging.info(f"{n_moved} finished requests moved to the request history")
 
     def archive_page(self, page):
-        page_obj = page.to_json()
-        page_obj["archived_at"] = datetime.now()
-        self._ap.insert_one(page_obj)
+        self.archive_pages([page])
+
+    def archive_pages(self, pages):
+        # upserted, so archiving a page twice keeps one document
+        from pymongo import UpdateOne
+        if len(pages) == 0:
+            return
+        archived_at = self._clock.now()
+        self._ap.bulk_write([ UpdateOne(
+            page.page_filter(),
+            {"$setOnInsert": {
+                **{ field: value for field, value in page.to_json().items() if field not in ("page_name", "key") },
+                "archived_at": archived_at,
+            }},
+            upsert=True,
+        ) for page in pages ], ordered=False)
 
     def is_page_archived(self, page):
-        return self._ap.count_documents({
-                "payload.page_name": page.to_json()["page_name"],
-                "payload.key": page.to_json()["key"],
-        }, limit=1) == 1
+        return self._ap.count_documents(page.page_filter(), limit=1) == 1
+
+    def filter_archived(self, requests):
+        if len(requests) == 0:
+            return requests
+        archived = set()
+        for page_json in self._ap.find(
+                {"$or": [ request.page.page_filter() for request in requests ]},
+                {"page_name": 1, "key": 1},
+        ):
+            archived.add(Page.json_identity(page_json))
+        return [ request for request in requests if request.page.identity not in archived ]
 
     def _check_stale_requests(self):
-        # @: max_processing_time configurable
-        # @: any request started processing before max_processing_time must be forced to fail
-        max_processing_time = 10
-        threshold_dt = datetime.now() - timedelta(seconds=max_processing_time)
-        self._rq.update_many(
+        threshold_dt = self._clock.now() - timedelta(seconds=self._max_processing_time)
+        self._update_many_tracked(
             {
                 "status": "processing",
                 "processing_started_at": {"$lte": threshold_dt }
@@ -395,59 +1419,286 @@ class RequestQueue:
             {
                 "$set": {
                     "status": "pending",
-                    "status_updated_at": datetime.now(),
+                    "status_updated_at": self._clock.now(),
                     "processing_started_at": None,
                 },
                 "$inc": {
                     "retries": 1,
                 },
             },
+            "processing", "pending",
         )
 
     def _check_failed_requests(self):
-        # @: max_retries configurable
-        max_retries = 2
-        self._rq.update_many(
+        def fail(doc):
+            doc["status"] = "failed"
+            doc["status_updated_at"] = self._clock.now()
+        self._move_to_history(
             {
                 "status": "pending",
-                "retries": {"$gte": max_retries+1},
+                "retries": {"$gt": self.max_retries},
             },
+            fail,
+        )
+
+    def _maintain(self):
+        now = self._clock.now()
+        if self._last_maintenance_at is not None and \
+           now < self._last_maintenance_at + timedelta(seconds=self._maintenance_interval):
+            return
+        self._last_maintenance_at = now
+        self._check_stale_requests()
+        self._check_failed_requests()
+
+    def _update_many_tracked(self, query, update, from_status, to_status):
+        # one update per page_name so the stats rollups stay exact
+        with self._stats.batch():
+            for page_name in self._rq.distinct("payload.page.page_name", query):
+                result = self._rq.update_many({**query, "payload.page.page_name": page_name}, update)
+                self._stats.transition(page_name, from_status, to_status, result.modified_count)
+        
+    def _saturated_page_names(self, finishing={}):
+        # finishing: {page_name: n} requests already processed whose end is
+        # still buffered (write-behind), they no longer count as processing
+        saturated = []
+        for page_name, page_cls in Page._registry.items():
+            if page_cls.max_concurrency is not None:
+                n_finishing = finishing.get(page_name, 0)
+                n_processing = self._count_status("processing", page_name, limit=page_cls.max_concurrency + n_finishing)
+                if n_processing - n_finishing >= page_cls.max_concurrency:
+                    saturated.append(page_name)
+        return saturated
+
+    def _lease(self, query):
+        now = self._clock.now()
+        return self._rq.find_one_and_update(
+            query,
             {
                 "$set": {
-                    "status": "failed",
-                    "status_updated_at": datetime.now(),
+                    "status": "processing",
+                    "status_updated_at": now,
+                    "processing_started_at": now,
                 },
             },
+            sort=[("payload.priority", -1), ("payload.next_update_at", 1)]
         )
-        
-    def get_next_request(self):
+
+    def _lease_fair(self, query, saturated):
+        # stride scheduling: page_names are tried from the lowest pass and each
+        # lease advances the served one by 1/weight. Those found with nothing
+        # due catch up with the served one, so idle time is not banked as
+        # credit; newcomers join at the current minimum pass.
+        page_names = [ name for name in Page._registry if name not in saturated ]
+        known = [ self._dequeue_passes[name] for name in page_names if name in self._dequeue_passes ]
+        min_pass = min(known) if len(known) > 0 else 0.0
+        for name in page_names:
+            self._dequeue_passes.setdefault(name, min_pass)
+        idle = []
+        for page_name in sorted(page_names, key=lambda name: (self._dequeue_passes[name], name)):
+            request_json = self._lease({**query, "payload.page.page_name": page_name})
+            if request_json is not None:
+                for name in idle:
+                    self._dequeue_passes[name] = max(self._dequeue_passes[name], self._dequeue_passes[page_name])
+                self._advance_pass(page_name)
+                return request_json
+            idle.append(page_name)
+        return None
+
+    def _advance_pass(self, page_name):
+        page_cls = Page._registry.get(page_name)
+        weight = page_cls.crawl_weight if page_cls is not None else 1
+        self._dequeue_passes[page_name] = self._dequeue_passes.get(page_name, 0.0) + 1 / weight
+
+    def next_due_at(self):
+        request_json = self._rq.find_one(
+            {"status": "pending"},
+            {"payload.next_update_at": 1},
+            sort=[("payload.next_update_at", 1)],
+        )
+        return request_json["payload"]["next_update_at"] if request_json is not None else None
+
+    def _lease_next(self, finishing={}):
+        self._maintain()
+        self._age_requests()
+        query = {
+            "status": "pending",
+            "payload.next_update_at": {"$lte": self._clock.now()},
+            "retries": {"$lte": self.max_retries},
+        }
+        if self._n_shards is not None:
+            self._heartbeat()
+            query["shard"] = {"$in": self._shards}
+        saturated = self._saturated_page_names(finishing)
+        if self._fair_dequeue:
+            request_json = self._lease_fair(query, saturated)
+        else:
+            if len(saturated) > 0:
+                query["payload.page.page_name"] = {"$nin": saturated}
+            request_json = self._lease(query)
+        if request_json is not None:
+            self._stats.transition(request_json["payload"]["page"]["page_name"], "pending", "processing")
+        return request_json
+
+    def get_next_request(self, on_idle=None, finishing=None):
+        # on_idle is called before waiting for requests to become due;
+        # finishing returns the requests processed but not ended yet, per
+        # page_name (see WriteBuffer.finishing)
         while True:
-            self._check_stale_requests()
-            self._check_failed_requests()
-            request_json = self._rq.find_one_and_update(
-                {
-                    "status": "pending",
-                    "payload.next_update_at": {"$lte": datetime.now()},
-                },
-                {
-                    "$set": {
-                        "status": "processing",
-                        "status_updated_at": datetime.now(),
-                    },
-                },
-                sort=[("payload.next_update_at", 1)]
-            )
-            if request_json is None:
-                # @: sleep time configurable
-                time.sleep(1)                
-            else:
+            # the rollups of a lease cycle are written at once
+            with self._stats.batch():
+                request_json = self._lease_next(finishing() if finishing is not None else {})
+            if request_json is not None:
                 return PageRequest.from_json(request_json["payload"], id_=request_json["_id"])
+            if on_idle is not None:
+                on_idle()
+            # @: sleep time configurable
+            self._clock.sleep(1)
     
 
+class WriteBuffer:
+    # Write-behind layer for the crawl loop. Writes of many processed pages
+    # are coalesced and flushed together once max_writes are buffered or the
+    # oldest one is max_delay seconds old. A flush writes items (and sweeps
+    # the ones finished parses did not yield), page states, archived pages,
+    # new requests and reschedules before completing the ended requests, so
+    # completed requests never miss items or children.
+    # With max_writes=0 every write is flushed right away.
+    def __init__(self, request_queue, item_store, change_tracker, max_writes=0, max_delay=5,
+                 max_failures=3, clock=None):
+        self._clock = clock if clock is not None else system_clock
+        self._request_queue = request_queue
+        self._item_store = item_store
+        self._change_tracker = change_tracker
+        self._max_writes = max_writes
+        self._max_delay = max_delay
+        self._max_failures = max_failures
+        self._reset()
+
+    def _reset(self):
+        self._items = {}
+        self._sweeps = []
+        self._states = {}
+        self._archived = []
+        self._new_requests = []
+        self._reschedules = []
+        self._ended = []
+        self._n_writes = 0
+        self._first_write_at = None
+        self._n_failures = 0
+
+    def _added(self, n=1):
+        self._n_writes += n
+        if self._first_write_at is None:
+            self._first_write_at = self._clock.time()
+        # after a failed flush, retries wait for flush_if_due
+        if self._n_failures == 0 and self._n_writes >= self._max_writes:
+            self.flush()
+
+    def add_items(self, items, page, parse_id, parsed_at):
+        # items of the parse parse_id, see ItemStore.write_items
+        key = (page.identity, parse_id)
+        if key in self._items:
+            self._items[key][1].extend(items)
+        else:
+            self._items[key] = (page, list(items), parse_id, parsed_at)
+        self._added(len(items))
+
+    def sweep_items(self, page, parse_id):
+        # once the parse parse_id finished, the items it did not yield go
+        self._sweeps.append((page, parse_id))
+        self._added()
+
+    def save_state(self, state):
+        self._states[Page.json_identity(state)] = state
+        self._added()
+
+    def archive_page(self, page):
+        self._archived.append(page)
+        self._added()
+
+    def add_requests(self, requests):
+        self._new_requests.extend(requests)
+        self._added(len(requests))
+
+    def reschedule(self, request, rescheduled_from):
+        # rescheduled_from: id of the request the page was processed in
+        self._reschedules.append((rescheduled_from, request))
+        self._added()
+
+    def end_request(self, request):
+        self._ended.append(request)
+        self._added()
+
+    def finishing(self):
+        # {page_name: n} ended requests still buffered, so still processing in the queue
+        counts = {}
+        for request in self._ended:
+            counts[request.page.page_name] = counts.get(request.page.page_name, 0) + 1
+        return counts
+
+    def is_due(self):
+        return self._first_write_at is not None and \
+            (self._n_writes >= self._max_writes or self._clock.time() >= self._first_write_at + self._max_delay)
+
+    def flush_if_due(self):
+        if self.is_due():
+            self.flush()
+
+    def flush(self):
+        # each section is cleared once written, so after a failure the next
+        # flush resumes with the failed one; all of them can be written twice.
+        # Errors are logged rather than raised, as the writes may belong to
+        # any of the buffered pages. After max_failures failed flushes in a
+        # row the writes are dropped: their requests are still processing,
+        # so they are recovered as stale requests and crawled again.
+        if self._first_write_at is None:
+            return True
+        try:
+            if len(self._items) > 0:
+                self._item_store.write_items(list(self._items.values()))
+                self._items = {}
+            if len(self._sweeps) > 0:
+                self._item_store.sweep_items(self._sweeps)
+                self._sweeps = []
+            if len(self._states) > 0:
+                self._change_tracker.save_states(list(self._states.values()))
+                self._states = {}
+            if len(self._archived) > 0:
+                self._request_queue.archive_pages(self._archived)
+                self._archived = []
+            if len(self._new_requests) > 0:
+                new_requests = self._request_queue.filter_archived(self._new_requests)
+                added = self._request_queue.add_requests(new_requests)
+                logging.info(f"{added} new requests added")
+                self._new_requests = []
+            if len(self._reschedules) > 0:
+                self._request_queue.reschedule_requests(self._reschedules)
+                self._reschedules = []
+            if len(self._ended) > 0:
+                self._request_queue.end_requests(self._ended)
+        except Exception:
+            self._n_failures += 1
+            if self._n_failures >= self._max_failures:
+                logging.exception(f"Flushing buffered writes failed {self._n_failures} times in a row, "
+                                  f"dropping them ({len(self._ended)} requests left processing)")
+                self._reset()
+            else:
+                logging.exception("Flushing buffered writes failed, retrying later")
+            return False
+        logging.debug(f"Flushed {self._n_writes} buffered writes")
+        self._reset()
+        return True
+
+
 class ParsingOutput:
-    def __init__(self):
+    # With on_items/on_pages callbacks, added objects are handed over in
+    # batches of batch_size instead of being kept until parsing finishes
+    def __init__(self, on_items=None, on_pages=None, batch_size=1000):
         self._items = []
         self._pages = []
+        self._on_items = on_items
+        self._on_pages = on_pages
+        self._batch_size = batch_size
 
     @property
     def items(self):
@@ -459,20 +1710,109 @@ class ParsingOutput:
     
     def add_item(self, item):
         self._items.append(item)
+        if self._on_items is not None and len(self._items) >= self._batch_size:
+            self._flush_items()
 
     def add_page(self, page):
         self._pages.append(page)
+        if self._on_pages is not None and len(self._pages) >= self._batch_size:
+            self._flush_pages()
+
+    def add(self, obj):
+        if isinstance(obj, Item):
+            self.add_item(obj)
+        elif isinstance(obj, Page):
+            self.add_page(obj)
+        else:
+            raise TypeError(f"Parsing results must be Items or Pages, got {type(obj).__name__}")
+
+    def extend(self, objs):
+        for obj in objs:
+            self.add(obj)
+
+    def _flush_items(self):
+        if len(self._items) > 0:
+            self._on_items(self._items)
+            self._items = []
+
+    def _flush_pages(self):
+        if len(self._pages) > 0:
+            self._on_pages(self._pages)
+            self._pages = []
+
+    def flush(self):
+        if self._on_items is not None:
+            self._flush_items()
+        if self._on_pages is not None:
+            self._flush_pages()
+
+    def add_links(self, urls, page_factory):
+        # page_factory maps each url to a Page, or None to ignore it
+        for url in urls:
+            page = page_factory(url)
+            if page is not None:
+                self.add_page(page)
 
 
 class Crawler:
-    _root_pages = []
+    _root_sources = []
     
-    def __init__(self, db_name, datalog_fpath, cache_path=None, request_delay=0):
+    def __init__(self, db_name, datalog_fpath, cache_path=None, request_delay=0,
+                 max_queued=None, fair_dequeue=False, respect_robots=False,
+                 user_agent="*", robots_ttl=24*3600, seed_batch_size=1000,
+                 profile=False, profile_rate=0.05, profile_interval=0.005, profile_dir="profiles",
+                 profile_signal=None,
+                 write_behind=False, write_batch_size=1000, write_interval=5, history_ttl=None,
+                 cache_max_entries=None, cache_max_age=None, shared_cache=None,
+                 connect_timeout=10, read_timeout=30, download_timeout=120, max_download_size=10*1024*1024,
+                 content_types=HTTPDownloader.html_content_types, head_probe=False,
+                 priority_aging=3600, shards=None, worker_id=None, worker_timeout=60,
+                 item_feed=False, item_feed_ttl=None, max_processing_time=600, clock=None):
+        from pymongo import MongoClient
+        # clock: SystemClock by default; a VirtualClock runs the crawl in simulated time
+        self._clock = clock if clock is not None else system_clock
         self._client = MongoClient()
         self._db = self._client[db_name]
-        self._downloader = HTTPDownloader(cache_path, request_delay)
-        self._request_queue = RequestQueue(self._db)
-        self._item_store = ItemStore(self._db)
+        self._robots = RobotsCache(user_agent, robots_ttl) if respect_robots else None
+        self._downloader = HTTPDownloader(None, request_delay, self._robots,
+                                          self._make_cache(cache_path, cache_max_entries, cache_max_age, shared_cache),
+                                          connect_timeout, read_timeout, download_timeout, max_download_size,
+                                          content_types, head_probe, clock=self._clock)
+        # shards: number of host shards to split the queue in among workers, None to disable
+        # max_processing_time must exceed the longest download and parse, or pages
+        # still being processed are handed to another worker
+        self._request_queue = RequestQueue(self._db, max_queued, fair_dequeue, history_ttl, priority_aging,
+                                           shards, worker_id, worker_timeout, max_processing_time,
+                                           clock=self._clock)
+        self._request_queue.migrate_history()
+        self._request_queue.migrate_priorities()
+        self._request_queue.migrate_shards()
+        self._seed_batch_size = seed_batch_size
+        self._item_store = ItemStore(self._db, self._clock, item_feed, item_feed_ttl)
+        self._change_tracker = ChangeTracker(self._db, self._clock)
+        self._stats = CrawlStats(self._db, self._clock)
+        if self._stats.is_empty():
+            self._stats.rebuild()
+        self._profiler = StackSampler(profile_dir, profile_rate, profile_interval, enabled=profile)
+        # profile_signal: name of a signal switching profiling on and off, e.g. "SIGUSR1"
+        self._profile_signal = profile_signal
+        # without write-behind, every write is flushed as soon as it is made
+        self._writes = WriteBuffer(self._request_queue, self._item_store, self._change_tracker,
+                                   max_writes=write_batch_size if write_behind else 0,
+                                   max_delay=write_interval, clock=self._clock)
+
+    def _make_cache(self, cache_path, max_entries, max_age, shared_cache):
+        # shared_cache: "gridfs", or the path of a directory shared by all nodes
+        cache = None
+        if cache_path is not None:
+            cache = CacheManager(cache_path, max_entries, max_age)
+        if shared_cache is not None:
+            if shared_cache == "gridfs":
+                shared = GridFSCache(self._db, max_age=max_age)
+            else:
+                shared = CacheManager(shared_cache, max_age=max_age, shared=True)
+            cache = TieredCache(cache, shared) if cache is not None else shared
+        return cache
 
     def _add_request(self, request, force=False):
         if force or not self._request_queue.is_page_archived(request.page):
@@ -480,56 +1820,229 @@ class Crawler:
             if added:
                 logging.info(f"New request {request} added")
 
+    def _add_requests(self, requests, budget=True):
+        requests = self._request_queue.filter_archived(requests)
+        added = self._request_queue.add_requests(requests, budget=budget)
+        logging.info(f"{added} new requests added")
+        return added
+
+    def seed_from_sitemap(self, sitemap_url, page_factory, batch_size=1000):
+        # page_factory maps each sitemap url to a Page, or None to ignore it
+        total = 0
+        batch = []
+        for url in iter_sitemap_urls(sitemap_url):
+            page = page_factory(url)
+            if page is None:
+                continue
+            batch.append(PageRequest(page, None, self._clock.now()))
+            if len(batch) >= batch_size:
+                total += self._add_requests(batch)
+                batch = []
+        total += self._add_requests(batch)
+        return total
+
+    def seed_from_robots(self, url, page_factory, batch_size=1000):
+        if self._robots is None:
+            raise ValueError("seed_from_robots requires respect_robots=True")
+        total = 0
+        for sitemap_url in self._robots.sitemaps(url):
+            total += self.seed_from_sitemap(sitemap_url, page_factory, batch_size)
+        return total
+
     def process_request(self, request):
+        with self._profiler.profile(request.page.page_name):
+            self._process_request(request)
+        self._writes.flush_if_due()
+
+    def _process_request(self, request):
         logging.info(f"Processing request {request}")
         try:
-            html = self._downloader.download(request.page.url())
-            output = request.page.parse(html)
+            content = self._downloader.fetch(request.page.url())
             last_updated_at = request.next_update_at
-            if len(output._items) > 0:
-                self._item_store.set_items(output._items, request.page)
-                for item in output._items:
-                    logging.info(f"Item {item} created from page {request.page}")
-            for page in output._pages:
-                new_request = PageRequest(page, last_updated_at, datetime.now())
-                self._add_request(new_request)
+            content_hash = None
+            state = None
+            duplicate_of = None
+            tracked = request.page.adaptive_revisit is not None or request.page.skip_unchanged
+            if tracked or request.page.dedup_content:
+                content_hash = ChangeTracker.content_hash(content, request.page.volatile_xpaths)
+            if tracked:
+                state = self._change_tracker.get_state(request.page)
+            if request.page.dedup_content:
+                duplicate_of = self._change_tracker.claim_content(request.page, content_hash)
+            if request.page.skip_unchanged and state is not None and state["content_hash"] == content_hash:
+                logging.info(f"Page {request.page} unchanged since last fetch, skipping parse")
+            elif duplicate_of is not None:
+                logging.info(f"Page {request.page} has the same content as <{duplicate_of['page_name']}>{duplicate_of['key']}, skipping parse")
+            else:
+                self._parse_page(request.page, content, last_updated_at)
+            if tracked:
+                state = ChangeTracker.updated_state(request.page, state, content_hash, self._clock.now())
+                self._writes.save_state(state)
 
             next_update_at = request.page.next_update_at(last_updated_at)
+            if next_update_at is not None and request.page.adaptive_revisit is not None:
+                next_update_at = request.page.adaptive_revisit.next_update_at(state, last_updated_at)
             if next_update_at is not None:
                 new_request = PageRequest(request.page, last_updated_at, next_update_at)
-                self._add_request(new_request, force=True)
+                self._writes.reschedule(new_request, request.id)
+                logging.info(f"Request {new_request} rescheduled")
             else:
-                self._request_queue.archive_page(request.page)
+                self._writes.archive_page(request.page)
                 logging.info(f"Page {request.page} added to archived list")
 
-            self._request_queue.end_request(request)
-        except ParsingError as e:
+            self._writes.end_request(request)
+        except (ParsingError, RobotsDisallowedError) as e:
             self._request_queue.fail_request(request, str(e), traceback.format_exc(), force=True)
+        except DownloadAbortedError as e:
+            logging.info(f"Download aborted ({e.reason}): {e}")
+            self._request_queue.fail_request(request, str(e), traceback.format_exc(), force=e.permanent, error_reason=e.reason)
         except Exception as e:
             self._request_queue.fail_request(request, str(e), traceback.format_exc())
     
+    def _parse_page(self, page, content, last_updated_at):
+        # batches of items are upserted as they come, and the previous items
+        # the parse did not yield are swept once it finished. Pages yielding
+        # no items keep their old ones (as before streaming)
+        parse_id = ItemStore.new_parse_id()
+        parsed_at = self._clock.now()
+        n_items = 0
+        def store_items(items):
+            nonlocal n_items
+            self._writes.add_items(items, page, parse_id, parsed_at)
+            n_items += len(items)
+            for item in items:
+                logging.info(f"Item {item} created from page {page}")
+        def store_pages(pages):
+            # due now, but strictly after last_updated_at: a virtual clock can
+            # still be exactly at the parent's due time (MongoDB keeps
+            # milliseconds, so the step is one millisecond)
+            next_update_at = self._clock.now()
+            if last_updated_at is not None and next_update_at <= last_updated_at:
+                next_update_at = last_updated_at + timedelta(milliseconds=1)
+            self._writes.add_requests([ PageRequest(new_page, last_updated_at, next_update_at) for new_page in pages ])
+        result = page.parse_content(content)
+        if isinstance(result, ParsingOutput):
+            if len(result.items) > 0:
+                store_items(result.items)
+            if len(result.pages) > 0:
+                store_pages(result.pages)
+        else:
+            output = ParsingOutput(store_items, store_pages, page.parse_batch_size)
+            output.extend(result)
+            output.flush()
+        if n_items > 0:
+            self._writes.sweep_items(page, parse_id)
+
+    @classmethod
+    def _iter_root_keys(cls, keys):
+        if callable(keys):
+            keys = keys()
+        if isinstance(keys, str):
+            keys = root_keys_from_file(keys)
+        yield from keys
+
+    @classmethod
+    def _root_source_id(cls, page_cls, keys):
+        # only files and callables are checkpointed: a static list is cheap to
+        # go through again, and add_requests skips the pages already queued
+        if isinstance(keys, str):
+            return f"root_page:{page_cls.page_name}:file:{os.path.abspath(keys)}"
+        if callable(keys):
+            return f"root_page:{page_cls.page_name}:{keys.__module__}.{keys.__qualname__}"
+        return None
+
+    def _seed_root_keys(self, page_cls, keys, checkpoint_id, checkpoint):
+        # the checkpoint holds the number of keys seeded and a digest of them:
+        # those keys are skipped if they are still the same, otherwise None
+        # is returned. Root pages bypass the queue budgets, so every key the
+        # checkpoint covers is queued (or was already)
+        skip = checkpoint["seeded"] if checkpoint is not None else 0
+        digest = hashlib.md5()
+        position = 0
+        added = 0
+        batch = []
+        def add_batch():
+            nonlocal added, batch
+            added += self._add_requests(batch, budget=False)
+            batch = []
+            if checkpoint_id is not None:
+                self._db.crawl_checkpoints.replace_one(
+                    {"_id": checkpoint_id},
+                    {"seeded": position, "digest": digest.hexdigest()},
+                    upsert=True)
+        for key in self._iter_root_keys(keys):
+            position += 1
+            digest.update(json.dumps(key, sort_keys=True, default=str).encode())
+            if position < skip:
+                continue
+            if position == skip:
+                if digest.hexdigest() != checkpoint["digest"]:
+                    return None
+                continue
+            page = page_cls() if key is None else page_cls(Key(**key))
+            batch.append(PageRequest(page, None, self._clock.now()))
+            if len(batch) >= self._seed_batch_size:
+                add_batch()
+        if position < skip:
+            return None
+        if len(batch) > 0:
+            add_batch()
+        return added
+
+    def _seed_root_pages(self):
+        # keys are consumed lazily and added in batches
+        for page_cls, keys in self._root_sources:
+            checkpoint_id = self._root_source_id(page_cls, keys)
+            checkpoint = None
+            if checkpoint_id is not None:
+                checkpoint = self._db.crawl_checkpoints.find_one({"_id": checkpoint_id})
+            added = self._seed_root_keys(page_cls, keys, checkpoint_id, checkpoint)
+            if added is None:
+                logging.info(f"Root keys of '{page_cls.page_name}' changed since the last seeding, seeding them again")
+                added = self._seed_root_keys(page_cls, keys, checkpoint_id, None)
+            if added > 0:
+                logging.info(f"Seeded {added} root pages of '{page_cls.page_name}'")
+
     def sync(self):        
-        for page in self._root_pages:
-            self._add_request(PageRequest(page, None, datetime.now()))
+        if self._profile_signal is not None:
+            self._profiler.install_signal_handler(self._profile_signal)
+        self._seed_root_pages()
+        self._request_queue.start_heartbeat()
         
-        while True:
-            request = self._request_queue.get_next_request()
-            self.process_request(request)
+        try:
+            while True:
+                request = self._request_queue.get_next_request(on_idle=self._writes.flush,
+                                                                finishing=self._writes.finishing)
+                self.process_request(request)
+        finally:
+            self._writes.flush()
+            self._request_queue.leave()
+
 
+def root_keys_from_file(fpath):
+    # one JSON object (the key values) per line
+    with open(fpath) as f:
+        for line in f:
+            if line.strip() != "":
+                yield json.loads(line)
 
 def root_page(keys):
-    if isclass(keys):
+    if isinstance(keys, type):
         # @root_page
         page_cls = keys
-        Crawler._root_pages.append(page_cls())
+        Crawler._root_sources.append((page_cls, [None]))
+        return page_cls
     else:
-        # @root_page([key])
+        # @root_page([key]), @root_page(generator), @root_page(callable) or @root_page("keys.jsonl")
         def wrapper(page_cls):
-            for key in keys:
-                Crawler._root_pages.append(page_cls(Key(**key)))
+            Crawler._root_sources.append((page_cls, keys))
             return page_cls
         return wrapper
 
 def register_page(page_cls):
     Page.register_page(page_cls.page_name, page_cls)
     return page_cls
+
+def index_items(type_, *attribs, unique=False):
+    # index_items("product", "sku", unique=True), index_items("product", "brand", ("price", -1))
+    Item.declare_index(type_, list(attribs), unique)
@@ -0,0 +1,19 @@
+import pytest
+
+
+@pytest.fixture(scope="session")
+def mongo_client():
+    # tests using the crawl database need a MongoDB server on localhost
+    pymongo = pytest.importorskip("pymongo")
+    client = pymongo.MongoClient(serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command("ping")
+    except pymongo.errors.PyMongoError:
+        pytest.skip("MongoDB server not available")
+    return client
+
+@pytest.fixture
+def db(mongo_client):
+    mongo_client.drop_database("syncrawl_test")
+    yield mongo_client["syncrawl_test"]
+    mongo_client.drop_database("syncrawl_test")
@@ -0,0 +1,117 @@
+from ..syncrawl import (
+    CacheManager,
+    TieredCache,
+)
+
+import os
+import time
+
+
+# CacheManager
+
+def test_cache_manager_evicts_least_recently_used(tmp_path):
+    cache = CacheManager(str(tmp_path), max_entries=2)
+    cache.store_cache("http://a", "A")
+    cache.store_cache("http://b", "B")
+    assert cache.retrieve_cached("http://a") == "A"
+    cache.store_cache("http://c", "C")
+    assert cache.retrieve_cached("http://b") is None
+    assert cache.retrieve_cached("http://a") == "A"
+    assert len(os.listdir(tmp_path / "bodies")) == 2
+    assert CacheManager(str(tmp_path)).retrieve_cached("http://c") == "C"
+
+def test_cache_manager_max_age(tmp_path):
+    cache = CacheManager(str(tmp_path), max_age=60)
+    cache.store_cache("http://a", "A")
+    assert cache.retrieve_cached("http://a") == "A"
+    fpath = os.path.join(tmp_path, CacheManager.cache_key("http://a") + ".ref")
+    os.utime(fpath, (time.time() - 120, time.time() - 120))
+    assert cache.retrieve_cached("http://a") is None
+
+def test_cache_manager_stores_bodies_once(tmp_path):
+    cache = CacheManager(str(tmp_path), max_entries=2)
+    cache.store_cache("http://a", "same")
+    cache.store_cache("http://a?ref=b", "same")
+    assert len(os.listdir(tmp_path / "bodies")) == 1
+    assert os.listdir(tmp_path / "bodies") == [CacheManager.body_hash("same")]
+    cache.store_cache("http://c", "other")
+    cache.store_cache("http://d", "another")
+    assert sorted(os.listdir(tmp_path / "bodies")) == sorted([ CacheManager.body_hash(c) for c in ["other", "another"] ])
+
+def test_cache_manager_reads_legacy_files(tmp_path):
+    with open(os.path.join(tmp_path, CacheManager.cache_key("http://a")), 'w') as f:
+        f.write("A")
+    cache = CacheManager(str(tmp_path))
+    assert cache.retrieve_cached("http://a") == "A"
+    cache.store_cache("http://a", "A2")
+    assert CacheManager(str(tmp_path)).retrieve_cached("http://a") == "A2"
+
+def test_shared_cache_sees_other_writers(tmp_path):
+    reader = CacheManager(str(tmp_path), shared=True)
+    CacheManager(str(tmp_path)).store_cache("http://a", "A")
+    assert reader.retrieve_cached("http://a") == "A"
+
+
+# TieredCache
+
+def test_tiered_cache(tmp_path):
+    shared = CacheManager(str(tmp_path / "shared"), shared=True)
+    node1 = TieredCache(CacheManager(str(tmp_path / "node1")), shared)
+    node2_l1 = CacheManager(str(tmp_path / "node2"))
+    node2 = TieredCache(node2_l1, shared)
+    node1.store_cache("http://a", "A")
+    assert node2_l1.retrieve_cached("http://a") is None
+    assert node2.retrieve_cached("http://a") == "A"
+    assert node2_l1.retrieve_cached("http://a") == "A"
+    assert node2.retrieve_cached("http://b") is None
+
+def test_cache_manager_write_atomic_temp_names(tmp_path, monkeypatch):
+    # every write goes through its own temp file, even with the same pid
+    opened = []
+    real_open = open
+    def spy_open(fpath, *args, **kwargs):
+        opened.append(str(fpath))
+        return real_open(fpath, *args, **kwargs)
+    monkeypatch.setattr("builtins.open", spy_open)
+    fpath = str(tmp_path / "a")
+    CacheManager._write_atomic(fpath, "A")
+    CacheManager._write_atomic(fpath, "B")
+    monkeypatch.undo()
+    tmp_fpaths = [ fpath for fpath in opened if fpath.endswith(".tmp") ]
+    assert len(tmp_fpaths) == 2 and tmp_fpaths[0] != tmp_fpaths[1]
+    assert os.listdir(tmp_path) == ["a"]
+    with open(fpath) as f:
+        assert f.read() == "B"
+
+def test_cache_manager_deletes_unreferenced_bodies(tmp_path):
+    cache = CacheManager(str(tmp_path))
+    for version in range(5):
+        cache.store_cache("http://a", f"A{version}")
+    assert os.listdir(tmp_path / "bodies") == [CacheManager.body_hash("A4")]
+    # a body is kept while another url refers to it, also across restarts
+    cache.store_cache("http://b", "A4")
+    cache = CacheManager(str(tmp_path))
+    cache.store_cache("http://a", "A5")
+    assert cache.retrieve_cached("http://b") == "A4"
+    cache.store_cache("http://b", "B")
+    assert sorted(os.listdir(tmp_path / "bodies")) == sorted([CacheManager.body_hash("A5"), CacheManager.body_hash("B")])
+    # the refcount is only read from disk when a body may become unreferenced
+    assert CacheManager(str(tmp_path))._refs is None
+
+def test_shared_cache_keeps_bodies(tmp_path):
+    # another node's url may still refer to the old body
+    node1 = CacheManager(str(tmp_path), shared=True)
+    node2 = CacheManager(str(tmp_path), shared=True)
+    node1.store_cache("http://a", "A")
+    node2.store_cache("http://b", "A")
+    node1.store_cache("http://a", "A2")
+    assert node2.retrieve_cached("http://b") == "A"
+
+def test_tiered_cache_keeps_l2_age(tmp_path):
+    shared = CacheManager(str(tmp_path / "shared"), shared=True, max_age=60)
+    l1 = CacheManager(str(tmp_path / "node"), max_age=60)
+    shared.store_cache("http://a", "A")
+    fpath = os.path.join(tmp_path / "shared", CacheManager.cache_key("http://a") + ".ref")
+    os.utime(fpath, (time.time() - 50, time.time() - 50))
+    assert TieredCache(l1, shared).retrieve_cached("http://a") == "A"
+    assert time.time() - os.path.getmtime(os.path.join(tmp_path / "node", CacheManager.cache_key("http://a") + ".ref")) >= 50
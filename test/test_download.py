@@ -0,0 +1,85 @@
+from ..syncrawl import (
+    HTTPDownloader,
+    DownloadAbortedError,
+)
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import time
+import pytest
+
+HTML = b"<html><body><p>hello</p></body></html>"
+
+
+@pytest.fixture
+def server():
+    files = {
+        "/page": ("text/html; charset=utf-8", HTML),
+        "/big": ("text/html", b"x" * 5000),
+        "/image": ("image/png", b"PNG"),
+        "/slow": ("text/html", b"x" * 20),
+    }
+    class Handler(BaseHTTPRequestHandler):
+        def _respond(self, with_body):
+            content_type, body = files[self.path]
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            if self.path != "/big":
+                self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if with_body and self.path == "/slow":
+                # a tarpit: one byte every 0.3s
+                try:
+                    for byte in body:
+                        self.wfile.write(bytes([byte]))
+                        self.wfile.flush()
+                        time.sleep(0.3)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up, as it should
+                    pass
+            elif with_body:
+                self.wfile.write(body)
+        def do_GET(self):
+            self._respond(True)
+        def do_HEAD(self):
+            self._respond(False)
+        def log_message(self, *args):
+            pass
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+# HTTPDownloader
+
+def test_fetch(server):
+    downloader = HTTPDownloader(None, 0)
+    assert downloader.fetch(f"{server}/page") == HTML.decode()
+
+def test_fetch_rejects_content_type(server):
+    for head_probe in [False, True]:
+        downloader = HTTPDownloader(None, 0, head_probe=head_probe)
+        with pytest.raises(DownloadAbortedError) as e:
+            downloader.fetch(f"{server}/image")
+        assert e.value.reason == "content_type"
+        assert e.value.permanent
+    assert HTTPDownloader(None, 0, content_types=None).fetch(f"{server}/image") == "PNG"
+
+def test_fetch_max_bytes(server):
+    downloader = HTTPDownloader(None, 0, max_bytes=1000, chunk_size=100)
+    with pytest.raises(DownloadAbortedError) as e:
+        downloader.fetch(f"{server}/big")
+    assert e.value.reason == "too_large"
+    assert downloader.fetch(f"{server}/page") == HTML.decode()
+
+def test_fetch_total_timeout(server):
+    downloader = HTTPDownloader(None, 0, total_timeout=1)
+    started_at = time.time()
+    with pytest.raises(DownloadAbortedError) as e:
+        downloader.fetch(f"{server}/slow")
+    assert time.time() - started_at < 3
+    assert e.value.reason == "timeout"
+    assert not e.value.permanent
+    assert downloader.fetch(f"{server}/page") == HTML.decode()
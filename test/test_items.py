@@ -0,0 +1,122 @@
+from ..syncrawl import (
+    Crawler,
+    FeedConsumer,
+    Item,
+    ItemFeed,
+    ItemStore,
+    Key,
+    Page,
+    ParsingOutput,
+    index_items,
+    register_page,
+)
+
+from datetime import datetime
+
+
+# Declared indexes
+
+def test_index_items():
+    index_items("test_product", "sku", unique=True)
+    index_items("test_product", "brand", ("price", -1))
+    index_items("test_product", "sku", unique=True)
+    assert Item._indexes.pop("test_product") == [
+        ((("sku", 1),), True),
+        ((("brand", 1), ("price", -1)), False),
+    ]
+
+
+# Query API
+
+def test_item_fields():
+    assert ItemStore.field("sku") == "item.sku"
+    assert ItemStore.field("_type") == "item._type"
+    assert ItemStore.field("parsed_at") == "parsed_at"
+    assert ItemStore.field("page.page_name") == "page.page_name"
+
+def test_cursor_roundtrip():
+    values = ["a", None, 3.5, datetime(2024, 1, 1)]
+    assert ItemStore.decode_cursor(ItemStore.encode_cursor(values)) == values
+
+def test_after_query():
+    sort = [("item.price", -1), ("_id", 1)]
+    assert ItemStore._after_query(sort, [10, "x"]) == {"$or": [
+        {"$or": [{"item.price": {"$lt": 10}}, {"item.price": None}]},
+        {"item.price": 10, "_id": {"$gt": "x"}},
+    ]}
+    assert ItemStore._after_query(sort, [None, "x"]) == {"$or": [
+        {"item.price": None, "_id": {"$gt": "x"}},
+    ]}
+    assert ItemStore._after_query([("item.price", 1), ("_id", 1)], [None, "x"]) == {"$or": [
+        {"item.price": {"$ne": None}},
+        {"item.price": None, "_id": {"$gt": "x"}},
+    ]}
+
+
+# Change feed
+
+def test_item_feed_diff():
+    old = {
+        "a": {"_id": "a", "_type": "t", "v": 1},
+        "b": {"_id": "b", "_type": "t", "v": [1, 2]},
+        "c": {"_id": "c", "_type": "t"},
+    }
+    new = {
+        "a": Item("a", "t", {"v": 2}).to_json(),
+        "b": Item("b", "t", {"v": (1, 2)}).to_json(),
+        "d": Item("d", "t", {}).to_json(),
+    }
+    assert ItemFeed.diff(old, new) == [
+        ("update", new["a"]),
+        ("insert", new["d"]),
+        ("delete", old["c"]),
+    ]
+    assert ItemFeed.diff(old, old) == []
+
+
+@register_page
+class Catalogue(Page):
+    page_name = "catalogue"
+    parse_batch_size = 2
+    products = {}
+    def url(self):
+        return f"http://test.com/catalogue/{self['id']}"
+    def next_update_at(self, last_updated_at):
+        return None
+    def parse(self, html):
+        for sku, price in self.products.items():
+            yield Item(sku, "product", {"price": price})
+
+def test_item_feed_streamed_parse(db, monkeypatch):
+    crawler = Crawler(db.name, None, item_feed=True)
+    consumer = FeedConsumer(db, "test")
+    page = Catalogue(Key(id=1))
+    def parse(products):
+        monkeypatch.setattr(Catalogue, "products", products)
+        crawler._parse_page(page, "<html></html>", None)
+        events = consumer.poll()
+        consumer.commit(events)
+        return sorted((event["op"], event["item"]["_id"]) for event in events)
+    products = { f"p{i}": i for i in range(5) }
+    assert parse(products) == [ ("insert", f"p{i}") for i in range(5) ]
+    # re-parsing unchanged items logs nothing, in any batch
+    assert parse(products) == []
+    assert db.item_store.count_documents({}) == 5
+    products = {**products, "p1": 10, "p5": 5}
+    del products["p3"]
+    assert parse(products) == [("delete", "p3"), ("insert", "p5"), ("update", "p1")]
+    assert sorted(doc["item"]["_id"] for doc in db.item_store.find()) == ["p0", "p1", "p2", "p4", "p5"]
+    # pages yielding no items keep their old ones
+    assert parse({}) == []
+    assert db.item_store.count_documents({}) == 5
+
+def test_item_feed_multi_page_write(db):
+    item_store = ItemStore(db, change_feed=True)
+    consumer = FeedConsumer(db, "test")
+    a, b = Catalogue(Key(id="a")), Catalogue(Key(id="b"))
+    item_store.set_items([Item("x", "product")], b)
+    consumer.commit(consumer.poll())
+    # b's stored x is only deleted, once, when b's items are swept
+    item_store.replace_items([(a, [Item("x", "product")]), (b, [Item("y", "product")])])
+    events = sorted((event["op"], event["page"]["key"]["id"], event["item"]["_id"]) for event in consumer.poll())
+    assert events == [("delete", "b", "x"), ("insert", "a", "x"), ("insert", "b", "y")]
@@ -0,0 +1,92 @@
+from ..web_gui import create_app, live
+
+from flask import request
+from pymongo.errors import PyMongoError
+from datetime import datetime, timedelta
+import json
+import pytest
+
+@pytest.fixture
+def app(db, tmp_path, monkeypatch):
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps({
+        "DB_HOST": "localhost",
+        "DB_PORT": 27017,
+        "DB_NAME": db.name,
+        "LIVE_POLL_INTERVAL": 0,
+    }))
+    monkeypatch.setenv("APP_CONF", str(config_path))
+    return create_app()
+
+def request_doc(_id, status, page_name="live_page", updated_at=None):
+    updated_at = updated_at if updated_at is not None else datetime.now() + timedelta(minutes=1)
+    return {
+        "_id": _id,
+        "status": status,
+        "status_updated_at": updated_at,
+        "payload": {
+            "page": {"page_name": page_name, "key": {"id": _id}, "attributes": {}, "url": f"http://test.com/{_id}"},
+            "last_updated_at": None,
+            "next_update_at": updated_at,
+            "priority": 0,
+        },
+    }
+
+
+# poll_changes
+
+def test_poll_changes(db):
+    changes = live.poll_changes(db, ["request_queue", "request_history"], "status_updated_at", 0)
+    db.request_history.insert_one(request_doc(1, "completed", updated_at=datetime.now() - timedelta(minutes=1)))
+    db.request_history.insert_one(request_doc(2, "completed"))
+    assert next(changes)["_id"] == 2
+    assert next(changes) is None
+    db.request_queue.insert_one(request_doc(3, "pending", updated_at=datetime.now() + timedelta(minutes=2)))
+    assert next(changes)["_id"] == 3
+
+
+# row_event
+
+def test_row_event(app):
+    doc = request_doc(1, "pending")
+    with app.test_request_context("/events/queue?page_name=live_page"):
+        event = live.row_event("queue", doc, request)
+        assert event["op"] == "upsert" and 'id="row-1"' in event["html"]
+        # finished requests leave the queue view
+        assert live.row_event("queue", request_doc(1, "completed"), request) == {"op": "remove", "id": "1"}
+    with app.test_request_context("/events/queue?page_name=other_page"):
+        assert live.row_event("queue", doc, request)["op"] == "remove"
+    item_doc = {
+        "_id": 5,
+        "item": {"_id": "a", "_type": "product", "name": "Blue chair"},
+        "page": doc["payload"]["page"],
+        "parsed_at": datetime.now(),
+    }
+    with app.test_request_context("/events/data?item_type=product&item_pattern=blue"):
+        assert live.row_event("data", item_doc, request)["op"] == "upsert"
+    with app.test_request_context("/events/data?item_pattern=red"):
+        assert live.row_event("data", item_doc, request)["op"] == "remove"
+
+
+# stream_events
+
+def test_stream_events_falls_back_to_polling(app, db, monkeypatch):
+    def no_change_streams(*args):
+        raise PyMongoError("change streams need a replica set")
+    monkeypatch.setattr(live, "watch_changes", no_change_streams)
+    with app.test_request_context("/events/completed"):
+        events = live.stream_events("completed", request)
+        assert next(events) == ": connected\n\n"
+        db.request_history.insert_one(request_doc(7, "completed"))
+        event = json.loads(next(events)[len("data: "):])
+        assert event["op"] == "upsert" and event["id"] == "7"
+
+
+# live_updates macro
+
+def test_live_updates_url(app):
+    from flask import get_template_attribute
+    with app.test_request_context("/"):
+        live_updates = get_template_attribute("macros.html", "live_updates")
+        html = str(live_updates("/events/data?page_name=a&item_type=b"))
+    assert 'startLiveUpdates("/events/data?page_name=a\\u0026item_type=b"' in html
@@ -0,0 +1,63 @@
+from ..syncrawl import (
+    Item,
+    Key,
+    Page,
+    ParsingOutput,
+)
+
+
+class Product(Page):
+    __slots__ = ()
+    page_name = "models_product"
+    def url(self):
+        return f"http://test.com/product/{self['id']}"
+    def next_update_at(self, last_updated_at):
+        return None
+    def parse(self, html):
+        return ParsingOutput()
+
+class UnslottedProduct(Product):
+    page_name = "models_unslotted"
+
+
+# Key
+
+def test_key_canonical():
+    assert Key(a=1, b="x") == Key(b="x", a=1)
+    assert hash(Key(a=1, b="x")) == hash(Key(b="x", a=1))
+    assert Key(a=1).canonical == '{"a":1}'
+    assert Key(a=1) != Key(a="1")
+
+
+# Page
+
+def test_page_identity():
+    p1 = Product(Key(id=1), name="a")
+    p2 = Product(Key(id=1), name="b")
+    assert p1.identity == p2.identity == Page.json_identity(p1.to_json())
+    assert p1 == p2 and hash(p1) == hash(p2)
+    assert p1 != Product(Key(id=2))
+    assert p1 != UnslottedProduct(Key(id=1))
+    assert len({p1, p2, Product(Key(id=2))}) == 2
+
+def test_page_to_json_is_cached_until_changed():
+    page = Product(Key(id=1), name="a")
+    page_json = page.to_json()
+    assert page.to_json() is page_json
+    page["name"] = "b"
+    assert page.to_json() is not page_json
+    assert page.to_json()["attributes"] == {"name": "b"}
+
+def test_page_slots():
+    assert not hasattr(Product(Key(id=1)), "__dict__")
+    assert hasattr(UnslottedProduct(Key(id=1)), "__dict__")
+
+
+# Item
+
+def test_item_to_json_is_cached():
+    item = Item("a", "t", {"v": 1})
+    assert item.to_json() is item.to_json()
+    assert item.to_json() == {"_id": "a", "_type": "t", "v": 1}
+    assert Item.from_json(item.to_json()) == item
+    assert not hasattr(item, "__dict__")
@@ -0,0 +1,66 @@
+from ..syncrawl import (
+    Key,
+    Item,
+    Page,
+    ParsingOutput,
+    register_page,
+)
+
+from datetime import timedelta
+import pytest
+
+CATALOGUE = "<html><body><ul>" + "".join(
+    f'<li class="product"><span>{i}</span><a href="/p/{i}">{i}</a></li>' for i in range(25)
+) + "</ul></body></html>"
+
+class Catalogue(Page):
+    page_name = "catalogue"
+    iterparse_tag = "li"
+    parse_batch_size = 10
+    def url(self):
+        return "http://test.com/catalogue"
+    def next_update_at(self, last_updated_at):
+        return last_updated_at + timedelta(days=1)
+    def parse(self, html):
+        for li in html:
+            # processed siblings are cleared while iterating
+            assert li.getprevious() is None or len(li.getprevious()) == 0
+            assert li.getprevious() is None or li.getprevious().getprevious() is None
+            yield Item(li.findtext("span"), "product", {"name": li.findtext("span")})
+            yield ProductPage(Key(id=li.findtext("span")))
+
+class ProductPage(Page):
+    page_name = "product_page"
+    def url(self):
+        return f"http://test.com/p/{self['id']}"
+    def next_update_at(self, last_updated_at):
+        return None
+    def parse(self, html):
+        return ParsingOutput()
+
+
+# ParsingOutput
+
+def test_parsing_output_batches():
+    item_batches = []
+    page_batches = []
+    out = ParsingOutput(lambda items: item_batches.append(len(items)),
+                        lambda pages: page_batches.append(len(pages)), batch_size=10)
+    register_page(Catalogue)
+    register_page(ProductPage)
+    out.extend(Catalogue().parse_content(CATALOGUE))
+    assert item_batches == [10, 10]
+    assert len(out.items) == 5
+    out.flush()
+    assert item_batches == [10, 10, 5]
+    assert page_batches == [10, 10, 5]
+    assert out.items == [] and out.pages == []
+
+def test_parsing_output_collects_without_sink():
+    out = ParsingOutput()
+    out.extend(Catalogue().parse_content(CATALOGUE))
+    out.flush()
+    assert len(out.items) == 25
+    assert out.pages[-1] == ProductPage(Key(id="24"))
+    with pytest.raises(TypeError):
+        out.add("not an item")
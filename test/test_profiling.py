@@ -0,0 +1,54 @@
+from ..syncrawl import (
+    StackSampler,
+)
+
+from tempfile import TemporaryDirectory
+import threading
+import signal
+import time
+import sys
+import os
+
+def busy(seconds):
+    t = time.time()
+    while time.time() - t < seconds:
+        sum(range(100))
+
+# StackSampler
+
+def test_stack_sampler_collapse():
+    stack = StackSampler.collapse(sys._getframe())
+    assert stack.split(";")[-1].startswith("test_stack_sampler_collapse (test_profiling.py:")
+
+def test_stack_sampler_profile():
+    with TemporaryDirectory() as tmp:
+        sampler = StackSampler(tmp, sample_rate=1.0, interval=0.001)
+        with sampler.profile("a"):
+            busy(0.05)
+        assert sampler._stacks == {}
+        sampler.enable()
+        with sampler.profile("a"):
+            busy(0.1)
+        sampler.toggle()
+        assert not sampler.enabled
+        with open(os.path.join(tmp, "a.collapsed")) as f:
+            lines = f.readlines()
+        assert len(lines) > 0
+        assert any([ "busy (test_profiling.py:" in line for line in lines ])
+        assert all([ int(line.rsplit(" ", 1)[1]) > 0 for line in lines ])
+
+def test_stack_sampler_signal_handler():
+    sampler = StackSampler("profiles")
+    assert not sampler.install_signal_handler("SIGNOTHERE")
+    installed = []
+    thread = threading.Thread(target=lambda: installed.append(sampler.install_signal_handler("SIGUSR1")))
+    thread.start()
+    thread.join()
+    assert installed == [False]
+    if hasattr(signal, "SIGUSR1"):
+        previous = signal.getsignal(signal.SIGUSR1)
+        try:
+            assert sampler.install_signal_handler("SIGUSR1")
+            assert signal.getsignal(signal.SIGUSR1) == sampler.toggle
+        finally:
+            signal.signal(signal.SIGUSR1, previous)
@@ -0,0 +1,174 @@
+from ..syncrawl import (
+    Key,
+    Page,
+    PageRequest,
+    ParsingOutput,
+    RequestQueue,
+    VirtualClock,
+    register_page,
+)
+
+from datetime import datetime, timedelta
+import pytest
+
+START = datetime(2024, 1, 1)
+
+@register_page
+class QueueA(Page):
+    page_name = "queue_a"
+    crawl_weight = 3
+    def url(self):
+        return f"http://a.test.com/{self['id']}"
+    def next_update_at(self, last_updated_at):
+        return None
+    def parse(self, html):
+        return ParsingOutput()
+
+@register_page
+class QueueB(QueueA):
+    page_name = "queue_b"
+    crawl_weight = 1
+    max_queued = 2
+    max_concurrency = 1
+    def url(self):
+        return f"http://b.test.com/{self['id']}"
+
+class Idle(Exception):
+    pass
+
+def raise_idle():
+    raise Idle()
+
+def requests(page_cls, ids, clock):
+    return [ PageRequest(page_cls(Key(id=i)), None, clock.now()) for i in ids ]
+
+@pytest.fixture
+def clock():
+    return VirtualClock(START)
+
+
+# Budgets
+
+def test_global_and_page_name_budgets(db, clock):
+    queue = RequestQueue(db, max_queued=5, clock=clock)
+    assert queue.add_requests(requests(QueueB, range(4), clock)) == 2
+    assert not queue.add_request(requests(QueueB, [9], clock)[0])
+    assert queue.add_requests(requests(QueueA, range(5), clock)) == 3
+    assert not queue.add_request(requests(QueueA, [9], clock)[0])
+    # reschedules bypass the budgets
+    assert queue.add_request(requests(QueueA, [9], clock)[0], force=True)
+    assert db.request_queue.count_documents({"status": "pending"}) == 6
+
+
+# Concurrency caps
+
+def test_max_concurrency(db, clock):
+    queue = RequestQueue(db, clock=clock)
+    queue.add_requests(requests(QueueB, [1, 2], clock) + requests(QueueA, [1], clock))
+    clock.sleep(1)
+    leased = [ queue.get_next_request().page.page_name for _ in range(2) ]
+    assert sorted(leased) == ["queue_a", "queue_b"]
+    # the second queue_b request waits for the first one to finish
+    with pytest.raises(Idle):
+        queue.get_next_request(on_idle=raise_idle)
+    # a finished request whose end is still buffered does not count
+    assert queue.get_next_request(finishing=lambda: {"queue_b": 1}).page.page_name == "queue_b"
+
+
+# Fair dequeue
+
+def test_fair_dequeue_weights(db, clock):
+    queue = RequestQueue(db, fair_dequeue=True, clock=clock)
+    queue.add_requests(requests(QueueA, range(20), clock))
+    db.request_queue.insert_many([ queue._request_doc(request) for request in requests(QueueB, range(20), clock) ])
+    clock.sleep(1)
+    leased = []
+    for _ in range(8):
+        request = queue.get_next_request()
+        leased.append(request.page.page_name)
+        queue.end_request(request)
+    assert leased.count("queue_a") == 6
+    assert leased.count("queue_b") == 2
+
+def test_fair_dequeue_does_not_bank_idle_time(db, clock):
+    queue = RequestQueue(db, fair_dequeue=True, clock=clock)
+    queue.add_requests(requests(QueueA, range(10), clock))
+    clock.sleep(1)
+    for _ in range(6):
+        queue.end_request(queue.get_next_request())
+    # queue_b was idle all along, so it only gets its share from now on
+    db.request_queue.insert_many([ queue._request_doc(request) for request in requests(QueueB, range(5), clock) ])
+    leased = []
+    for _ in range(4):
+        request = queue.get_next_request()
+        leased.append(request.page.page_name)
+        queue.end_request(request)
+    assert leased.count("queue_b") == 1
+
+
+# Stale requests
+
+def test_stale_requests_are_recovered(db, clock):
+    queue = RequestQueue(db, max_processing_time=600, clock=clock)
+    queue.add_requests(requests(QueueA, [1], clock))
+    clock.sleep(1)
+    request = queue.get_next_request()
+    doc = db.request_queue.find_one({"_id": request.id})
+    assert doc["processing_started_at"] == clock.now()
+    clock.sleep(300)
+    queue._check_stale_requests()
+    assert db.request_queue.find_one({"_id": request.id})["status"] == "processing"
+    clock.sleep(301)
+    assert queue.get_next_request().id == request.id
+    assert db.request_queue.find_one({"_id": request.id})["retries"] == 1
+
+
+# Request history
+
+def test_finished_requests_move_to_history(db, clock):
+    queue = RequestQueue(db, clock=clock)
+    queue.add_requests(requests(QueueA, [1, 2], clock))
+    clock.sleep(1)
+    done = queue.get_next_request()
+    queue.end_request(done)
+    failed = queue.get_next_request()
+    queue.fail_request(failed, "error", "traceback", force=True)
+    assert db.request_queue.count_documents({}) == 0
+    assert db.request_history.find_one({"_id": done.id})["status"] == "completed"
+    assert db.request_history.find_one({"_id": failed.id})["status"] == "failed"
+    # failed pages are not requested again, completed ones are
+    assert not queue.add_request(requests(QueueA, [failed.page["id"]], clock)[0])
+    assert queue.add_request(requests(QueueA, [done.page["id"]], clock)[0])
+
+def test_end_requests_empty(db, clock):
+    queue = RequestQueue(db, clock=clock)
+    queue._rq = None
+    queue.end_requests([])
+
+def test_migrate_history(db, clock):
+    queue = RequestQueue(db, clock=clock)
+    docs = [ queue._request_doc(request) for request in requests(QueueA, range(3), clock) ]
+    docs[0]["status"] = "completed"
+    docs[1]["status"] = "failed"
+    db.request_queue.insert_many(docs)
+    queue.migrate_history()
+    assert [ doc["status"] for doc in db.request_queue.find() ] == ["pending"]
+    assert sorted(doc["status"] for doc in db.request_history.find()) == ["completed", "failed"]
+    queue.migrate_history()
+    assert db.request_history.count_documents({}) == 2
+
+
+# Priority aging
+
+def test_requests_age_once_per_interval_across_workers(db, clock):
+    workers = [ RequestQueue(db, aging_interval=3600, clock=clock) for _ in range(3) ]
+    workers[0].add_requests(requests(QueueA, [1], clock))
+    clock.sleep(3601)
+    for _ in range(2):
+        for worker in workers:
+            worker._age_requests()
+    assert db.request_queue.find_one()["payload"]["priority"] == 1
+    clock.sleep(3600)
+    for worker in workers:
+        worker._age_requests()
+    assert db.request_queue.find_one()["payload"]["priority"] == 2
@@ -0,0 +1,66 @@
+from ..syncrawl import (
+    CacheManager,
+    Item,
+    Key,
+    Page,
+    PageRequest,
+    ParsingOutput,
+    RequestQueue,
+    register_page,
+)
+from ..syncrawl.reparse import Reparser
+
+from datetime import datetime
+import os
+
+@register_page
+class Listing(Page):
+    __slots__ = ()
+    page_name = "reparse_listing"
+    def url(self):
+        return f"http://test.com/listing/{self['id']}"
+    def next_update_at(self, last_updated_at):
+        return None
+    def parse(self, html):
+        out = ParsingOutput()
+        for name in map(str, html.xpath("//li/text()")):
+            out.add_item(Item(f"{self['id']}:{name}", "entry", {"name": name}))
+        if self['id'] == 1:
+            out.add_page(Listing(Key(id=3)))
+        return out
+
+def html(names):
+    return "<html><body><ul>" + "".join([ f"<li>{name}</li>" for name in names ]) + "</ul></body></html>"
+
+
+# Reparser
+
+def test_reparse_from_cache(db, tmp_path):
+    cache = CacheManager(str(tmp_path / "cache"))
+    queue = RequestQueue(db)
+    queue.add_requests([ PageRequest(Listing(Key(id=i)), None, datetime.now()) for i in [1, 2, 4] ])
+    cache.store_cache(Listing(Key(id=1)).url(), html(["a", "b"]))
+    cache.store_cache(Listing(Key(id=2)).url(), html(["c"]))
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+    reparser = Reparser(db.name, str(tmp_path / "cache"), processes=1, batch_size=2, checkpoint_path=checkpoint_path)
+    counts = reparser.run("queue")
+    assert counts == {"parsed": 2, "missing": 1, "failed": 0, "requests": 1}
+    assert sorted([ doc["item"]["_id"] for doc in db.item_store.find() ]) == ["1:a", "1:b", "2:c"]
+    assert db.request_queue.count_documents({"payload.page.key": {"id": 3}}) == 1
+    assert os.path.exists(checkpoint_path)
+    # a finished run is resumed after its last page, so nothing is parsed again
+    cache.store_cache(Listing(Key(id=2)).url(), html(["d"]))
+    assert reparser.run("queue") == counts
+    assert db.item_store.count_documents({"item._id": "2:d"}) == 0
+    os.remove(checkpoint_path)
+    reparser.run("queue")
+    assert sorted([ doc["item"]["_id"] for doc in db.item_store.find() ]) == ["1:a", "1:b", "2:d"]
+
+def test_reparse_shards_new_requests(db, tmp_path):
+    RequestQueue(db, n_shards=8).migrate_shards()
+    queue = RequestQueue(db)
+    queue.add_requests([ PageRequest(Listing(Key(id=1)), None, datetime.now()) ])
+    CacheManager(str(tmp_path)).store_cache(Listing(Key(id=1)).url(), html(["a"]))
+    Reparser(db.name, str(tmp_path), processes=1).run("queue")
+    doc = db.request_queue.find_one({"payload.page.key": {"id": 3}})
+    assert doc["shard"] == RequestQueue.shard_of(Listing(Key(id=3)).url(), 8)
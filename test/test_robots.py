@@ -0,0 +1,88 @@
+from ..syncrawl import (
+    RobotsCache,
+    iter_sitemap_urls,
+)
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import threading
+import gzip
+import pytest
+
+ROBOTS = b"""User-agent: *
+Disallow: /private/
+Crawl-delay: 2
+Sitemap: http://example.com/sitemap_index.xml
+"""
+
+SITEMAP_INDEX = b"""<?xml version="1.0" encoding="UTF-8"?>
+<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+  <sitemap><loc>{base}/sitemap1.xml</loc></sitemap>
+  <sitemap><loc>{base}/sitemap2.xml.gz</loc></sitemap>
+</sitemapindex>
+"""
+
+SITEMAP = b"""<?xml version="1.0" encoding="UTF-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+  <url><loc>http://example.com/a</loc><lastmod>2024-01-01</lastmod></url>
+  <url><loc> http://example.com/b </loc></url>
+</urlset>
+"""
+
+SITEMAP_GZ = gzip.compress(SITEMAP.replace(b"/a<", b"/c<").replace(b"/b ", b"/d "))
+
+
+@pytest.fixture
+def server():
+    files = {}
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in files:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(files[self.path])
+        def log_message(self, *args):
+            pass
+    httpd = HTTPServer(("127.0.0.1", 0), Handler)
+    base = f"http://127.0.0.1:{httpd.server_port}"
+    files["/robots.txt"] = ROBOTS
+    files["/sitemap_index.xml"] = SITEMAP_INDEX.replace(b"{base}", base.encode())
+    files["/sitemap1.xml"] = SITEMAP
+    files["/sitemap2.xml.gz"] = SITEMAP_GZ
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield base
+    httpd.shutdown()
+
+
+# RobotsCache
+
+def test_robots_cache(server):
+    robots = RobotsCache()
+    assert robots.can_fetch(f"{server}/public/page")
+    assert not robots.can_fetch(f"{server}/private/page")
+    assert robots.crawl_delay(f"{server}/") == 2
+    assert robots.sitemaps(f"{server}/") == ["http://example.com/sitemap_index.xml"]
+    assert len(robots._rules) == 1
+    assert RobotsCache.host_of(f"{server}/a/b?c=d") == server
+
+def test_robots_cache_missing(server):
+    robots = RobotsCache()
+    assert robots.can_fetch("http://127.0.0.1:1/anything")
+
+
+# Sitemaps
+
+def test_iter_sitemap_urls(server):
+    urls = list(iter_sitemap_urls(f"{server}/sitemap1.xml"))
+    assert urls == ["http://example.com/a", "http://example.com/b"]
+    urls = list(iter_sitemap_urls(f"{server}/sitemap_index.xml"))
+    assert urls == [
+        "http://example.com/a",
+        "http://example.com/b",
+        "http://example.com/c",
+        "http://example.com/d",
+    ]
+    assert list(iter_sitemap_urls(f"{server}/sitemap_index.xml", max_depth=0)) == []
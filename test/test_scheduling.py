@@ -0,0 +1,152 @@
+from ..syncrawl import (
+    AdaptiveScheduler,
+    ChangeTracker,
+    Key,
+    Page,
+    PageRequest,
+    ParsingOutput,
+    RequestQueue,
+    VirtualClock,
+    register_page,
+)
+
+from datetime import datetime, timedelta
+import pytest
+import time
+
+# AdaptiveScheduler
+
+def test_adaptive_scheduler_estimate_change_rate():
+    assert AdaptiveScheduler.estimate_change_rate(0, 0, 0) is None
+    assert AdaptiveScheduler.estimate_change_rate(10, 0, 100) == 0
+    r1 = AdaptiveScheduler.estimate_change_rate(10, 2, 100)
+    r2 = AdaptiveScheduler.estimate_change_rate(10, 8, 100)
+    assert 0 < r1 < r2
+    assert AdaptiveScheduler.estimate_change_rate(10, 10, 100) > r2
+
+def test_adaptive_scheduler_bounds():
+    with pytest.raises(ValueError):
+        AdaptiveScheduler(timedelta(days=2), timedelta(days=1))
+    s = AdaptiveScheduler(timedelta(hours=1), timedelta(days=10))
+    assert s.next_interval(None) == timedelta(hours=1)
+    static = {"n_checks": 20, "n_changes": 0, "observed_seconds": 20 * 3600}
+    assert s.next_interval(static) == timedelta(days=10)
+    volatile = {"n_checks": 20, "n_changes": 20, "observed_seconds": 20 * 3600}
+    assert s.next_interval(volatile) == timedelta(hours=1)
+    moderate = {"n_checks": 20, "n_changes": 2, "observed_seconds": 20 * 86400}
+    assert timedelta(hours=1) < s.next_interval(moderate) < timedelta(days=10)
+    dt = datetime(2024, 1, 1)
+    assert s.next_update_at(static, dt) == dt + timedelta(days=10)
+
+
+# ChangeTracker
+
+def test_change_tracker_content_hash():
+    h1 = "<html><body><p>Price: 5</p><span id='ts'>12:00</span> tail</body></html>"
+    h2 = "<html><body><p>Price: 5</p><span id='ts'>12:05</span> tail</body></html>"
+    h3 = "<html><body><p>Price: 6</p><span id='ts'>12:05</span> tail</body></html>"
+    h4 = "<html><body><p>Price: 5</p><span id='ts'>12:05</span> other</body></html>"
+    assert ChangeTracker.content_hash(h1) == ChangeTracker.content_hash(h1)
+    assert ChangeTracker.content_hash(h1) != ChangeTracker.content_hash(h2)
+    volatile = ["//span[@id='ts']"]
+    assert ChangeTracker.content_hash(h1, volatile) == ChangeTracker.content_hash(h2, volatile)
+    assert ChangeTracker.content_hash(h2, volatile) != ChangeTracker.content_hash(h3, volatile)
+    assert ChangeTracker.content_hash(h2, volatile) != ChangeTracker.content_hash(h4, volatile)
+
+
+# PageRequest priority
+
+class Urgent(Page):
+    page_name = "urgent"
+    priority = 5
+    def url(self):
+        return f"http://test.com/urgent/{self['id']}"
+    def next_update_at(self, last_updated_at):
+        return None
+    def parse(self, html):
+        return ParsingOutput()
+
+def test_page_request_priority():
+    register_page(Urgent)
+    now = datetime.now()
+    assert PageRequest(Urgent(Key(id=1)), None, now).priority == 5
+    request = PageRequest(Urgent(Key(id=1)), None, now, priority=9)
+    assert request.priority == 9
+    assert PageRequest.from_json(request.to_json(), id_=None).priority == 9
+    legacy = request.to_json()
+    del legacy["priority"]
+    assert PageRequest.from_json(legacy, id_=None).priority == 5
+
+
+def test_change_tracker_claim_content(db):
+    tracker = ChangeTracker(db)
+    owner, duplicate = Urgent(Key(id=1)), Urgent(Key(id=2))
+    assert tracker.claim_content(owner, "h1") is None
+    assert tracker.claim_content(duplicate, "h1") == owner.page_filter()
+    assert tracker.claim_content(owner, "h1") is None
+    # the owner changed, so the duplicate still serving h1 takes it over
+    assert tracker.claim_content(owner, "h2") is None
+    assert tracker.claim_content(duplicate, "h1") is None
+    assert tracker.claim_content(owner, "h1") == duplicate.page_filter()
+
+
+# Host shards
+
+def test_shard_of_host():
+    assert RequestQueue.shard_of("http://a.com/x", 64) == RequestQueue.shard_of("http://a.com/y?z=1", 64)
+    assert 0 <= RequestQueue.shard_of("http://b.com/", 64) < 64
+    assert RequestQueue.shard_of("http://a.com/", 64) == RequestQueue.shard_of("https://a.com:8443/", 64)
+
+def test_assign_shards_moves_only_new_worker_share():
+    before = RequestQueue.assign_shards(["w1", "w2", "w3"], 64)
+    assert sorted(sum(before.values(), [])) == list(range(64))
+    after = RequestQueue.assign_shards(["w1", "w2", "w3", "w4"], 64)
+    for worker_id in ["w1", "w2", "w3"]:
+        assert set(after[worker_id]) <= set(before[worker_id])
+    assert len(after["w4"]) > 0
+
+def test_migrate_shards_reshards_on_change(db):
+    clock = VirtualClock(datetime(2024, 1, 1))
+    queue = RequestQueue(db, n_shards=2, clock=clock)
+    queue.add_requests([ PageRequest(Urgent(Key(id=i)), None, clock.now()) for i in range(5) ])
+    db.request_queue.update_many({}, {"$set": {"payload.page.url": "http://other.com/"}})
+    queue = RequestQueue(db, n_shards=64, clock=clock)
+    queue.migrate_shards(batch_size=2)
+    shard = RequestQueue.shard_of("http://other.com/", 64)
+    assert [ doc["shard"] for doc in db.request_queue.find() ] == [shard] * 5
+    # with the same number of shards only the missing ones are filled in
+    db.request_queue.update_one({}, {"$unset": {"shard": ""}})
+    db.request_queue.update_one({"shard": {"$exists": True}}, {"$set": {"shard": 0}})
+    queue.migrate_shards()
+    assert sorted(doc["shard"] for doc in db.request_queue.find()) == sorted([0] + [shard] * 4)
+
+def test_heartbeat_thread(db):
+    queue = RequestQueue(db, n_shards=4, worker_id="w1", worker_timeout=0.3)
+    queue.start_heartbeat()
+    try:
+        time.sleep(0.25)
+        first = db.crawl_workers.find_one({"_id": "w1"})["heartbeat_at"]
+        time.sleep(0.25)
+        assert db.crawl_workers.find_one({"_id": "w1"})["heartbeat_at"] > first
+    finally:
+        queue.leave()
+    assert db.crawl_workers.find_one({"_id": "w1"}) is None
+
+def test_dead_worker_requests_are_recovered(db):
+    clock = VirtualClock(datetime(2024, 1, 1))
+    dead = RequestQueue(db, n_shards=1, worker_id="dead", worker_timeout=60, max_processing_time=600, clock=clock)
+    dead.add_requests([ PageRequest(Urgent(Key(id=1)), None, clock.now()) ])
+    request = dead.get_next_request()
+    clock.sleep(601)
+    alive = RequestQueue(db, n_shards=1, worker_id="alive", worker_timeout=60, max_processing_time=600, clock=clock)
+    assert alive.get_next_request().id == request.id
+
+def test_migrate_shards_reshards_on_key_change(db):
+    clock = VirtualClock(datetime(2024, 1, 1))
+    queue = RequestQueue(db, n_shards=64, clock=clock)
+    queue.add_requests([ PageRequest(Urgent(Key(id=1)), None, clock.now()) ])
+    # shards stored by an older shard key
+    db.crawl_checkpoints.replace_one({"_id": "request_shards"}, {"n_shards": 64}, upsert=True)
+    db.request_queue.update_many({}, {"$set": {"shard": -1}})
+    queue.migrate_shards()
+    assert db.request_queue.find_one()["shard"] == RequestQueue.shard_of("http://test.com/urgent/1", 64)
@@ -0,0 +1,81 @@
+from ..syncrawl import (
+    Crawler,
+    Page,
+    ParsingOutput,
+    register_page,
+)
+
+import pytest
+
+@register_page
+class SeedLang(Page):
+    page_name = "seed_lang"
+    max_queued = 2
+    def url(self):
+        return f"http://seed.test.com/{self['lang']}"
+    def next_update_at(self, last_updated_at):
+        return None
+    def parse(self, html):
+        return ParsingOutput()
+
+@pytest.fixture
+def root_sources(monkeypatch):
+    sources = []
+    monkeypatch.setattr(Crawler, "_root_sources", sources)
+    return sources
+
+def seed(db, root_sources, keys, **kwargs):
+    root_sources[:] = [(SeedLang, keys)]
+    crawler = Crawler(db.name, None, seed_batch_size=2, **kwargs)
+    crawler._seed_root_pages()
+    return crawler
+
+def queued_langs(db):
+    return sorted(doc["payload"]["page"]["key"]["lang"] for doc in db.request_queue.find())
+
+def langs(*values):
+    return [ {"lang": value} for value in values ]
+
+
+def test_static_list_change_is_seeded(db, root_sources):
+    seed(db, root_sources, langs("en"))
+    seed(db, root_sources, langs("eu", "en"))
+    assert queued_langs(db) == ["en", "eu"]
+
+def test_root_pages_bypass_budgets(db, root_sources):
+    seed(db, root_sources, langs("a", "b", "c", "d", "e"), max_queued=2)
+    assert queued_langs(db) == ["a", "b", "c", "d", "e"]
+
+def test_file_checkpoint(db, root_sources, tmp_path):
+    fpath = tmp_path / "keys.jsonl"
+    def write_keys(*values):
+        fpath.write_text("".join(f'{{"lang": "{value}"}}\n' for value in values))
+    write_keys("a", "b", "c")
+    seed(db, root_sources, str(fpath))
+    db.request_queue.delete_many({})
+    # appended keys are seeded, the ones already seeded are skipped
+    write_keys("a", "b", "c", "d")
+    seed(db, root_sources, str(fpath))
+    assert queued_langs(db) == ["d"]
+    # a key inserted before the checkpoint invalidates it
+    write_keys("x", "a", "b", "c", "d")
+    seed(db, root_sources, str(fpath))
+    assert queued_langs(db) == ["a", "b", "c", "d", "x"]
+    # so does a file shorter than the checkpoint
+    db.request_queue.delete_many({})
+    write_keys("y")
+    seed(db, root_sources, str(fpath))
+    assert queued_langs(db) == ["y"]
+
+def test_callable_checkpoint(db, root_sources):
+    values = ["a", "b", "c"]
+    def keys():
+        return (key for key in langs(*values))
+    seed(db, root_sources, keys)
+    db.request_queue.delete_many({})
+    values[:] = ["a", "b", "c", "d", "e"]
+    seed(db, root_sources, keys)
+    assert queued_langs(db) == ["d", "e"]
+    values[:] = ["z", "b", "c", "d", "e"]
+    seed(db, root_sources, keys)
+    assert queued_langs(db) == ["b", "c", "d", "e", "z"]
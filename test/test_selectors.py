@@ -0,0 +1,82 @@
+from ..syncrawl import (
+    Key,
+    Page,
+    ParsingOutput,
+    Selector,
+    XPathSelector,
+    CSSSelector,
+    HTTPDownloader,
+    register_page,
+)
+
+from datetime import timedelta
+import pytest
+
+HTML = """<html><body>
+<h1>Title</h1>
+<a class="detail" href="/item/1">1</a>
+<a class="detail" href="http://other.com/item/2">2</a>
+<a class="detail" href="/item/1">1 again</a>
+<a href="/about">about</a>
+</body></html>"""
+
+class Listing(Page):
+    page_name = "listing"
+    title = XPathSelector("//h1/text()", first=True)
+    detail_links = XPathSelector("//a[@class='detail']/@href")
+    missing = XPathSelector("//h2/text()", first=True)
+    def url(self):
+        return "http://test.com/list/"
+    def next_update_at(self, last_updated_at):
+        return last_updated_at + timedelta(days=1)
+    def parse(self, html):
+        out = ParsingOutput()
+        out.add_links(self.extract_links(html, self.detail_links),
+                      lambda url: Detail(Key(url=url)) if "test.com" in url else None)
+        return out
+
+class Detail(Page):
+    page_name = "detail"
+    def url(self):
+        return self['url']
+    def next_update_at(self, last_updated_at):
+        return None
+    def parse(self, html):
+        return ParsingOutput()
+
+
+# Selectors
+
+def test_xpath_selector():
+    register_page(Listing)
+    assert Listing.title._compiled is not None
+    html = HTTPDownloader.parse(HTML)
+    page = Listing()
+    assert page.title(html) == "Title"
+    assert page.missing(html) is None
+    assert len(page.detail_links(html)) == 3
+    assert list(page.extract_links(html, page.detail_links)) == [
+        "http://test.com/item/1",
+        "http://other.com/item/2",
+    ]
+    out = page.parse(html)
+    assert out.pages == [Detail(Key(url="http://test.com/item/1"))]
+
+def test_invalid_selector_fails_at_registration():
+    class Broken(Listing):
+        page_name = "broken"
+        price = XPathSelector("//span[@class='price'")
+    with pytest.raises(ValueError):
+        register_page(Broken)
+    assert "broken" not in Page._registry
+
+def test_selector_is_abstract():
+    with pytest.raises(TypeError):
+        Selector("//h1")
+
+def test_css_selector():
+    pytest.importorskip("cssselect")
+    html = HTTPDownloader.parse(HTML)
+    links = CSSSelector("a.detail")
+    links.compile()
+    assert [ a.get("href") for a in links(html) ][:2] == ["/item/1", "http://other.com/item/2"]
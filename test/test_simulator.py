@@ -0,0 +1,92 @@
+from ..syncrawl import (
+    Crawler,
+    Key,
+    Page,
+    VirtualClock,
+    register_page,
+)
+from ..syncrawl.simulator import SiteModel, SimulationReport, Simulator
+
+from datetime import datetime, timedelta
+
+
+# VirtualClock
+
+def test_virtual_clock():
+    start = datetime(2024, 1, 1)
+    clock = VirtualClock(start)
+    clock.sleep(90)
+    assert clock.now() == start + timedelta(seconds=90)
+    assert clock.time() == (start + timedelta(seconds=90)).timestamp()
+    clock.advance_to(start)
+    assert clock.now() == start + timedelta(seconds=90)
+    clock.advance_to(start + timedelta(days=30))
+    assert clock.now() == start + timedelta(days=30)
+
+
+# SiteModel
+
+def test_site_model_changes():
+    start = datetime(2024, 1, 1)
+    site = SiteModel(lambda url: 4 if url.endswith("hot") else 0, links=lambda url: ["http://x/cold"])
+    site.start = start
+    month = start + timedelta(days=30)
+    assert site.version_at("http://x/cold", month) == 0
+    assert site.first_change_after("http://x/cold", start, month) is None
+    n_changes = site.version_at("http://x/hot", month)
+    assert 60 < n_changes < 180
+    first = site.first_change_after("http://x/hot", start, month)
+    assert site.version_at("http://x/hot", first) == 1
+    assert site.version_at("http://x/hot", first - timedelta(microseconds=1)) == 0
+    other = SiteModel(lambda url: 4)
+    other.start = start
+    assert other.version_at("http://x/hot", month) == n_changes
+    assert 'href="http://x/cold"' in site.content("http://x/hot", month)
+
+
+# SimulationReport
+
+def test_simulation_report():
+    report = SimulationReport()
+    report.fetched(None)
+    report.fetched(timedelta(hours=1))
+    report.fetched(timedelta(hours=3))
+    assert report.n_fetches == 3 and report.n_changed == 2
+    assert report.mean_lag == timedelta(hours=2)
+    assert report.max_lag == timedelta(hours=3)
+    assert "2 found changes" in report.summary()
+
+
+# Simulator
+
+@register_page
+class SimIndex(Page):
+    page_name = "sim_index"
+    def url(self):
+        return "http://sim.test.com/"
+    def next_update_at(self, last_updated_at):
+        return last_updated_at + timedelta(hours=6)
+    def parse(self, html):
+        for href in html.xpath("//a/@href"):
+            yield SimArticle(Key(id=href.rsplit("/", 1)[1]))
+
+@register_page
+class SimArticle(Page):
+    page_name = "sim_article"
+    def url(self):
+        return f"http://sim.test.com/{self['id']}"
+    def next_update_at(self, last_updated_at):
+        return last_updated_at + timedelta(days=1)
+    def parse(self, html):
+        return []
+
+def test_simulator_run(db, monkeypatch):
+    monkeypatch.setattr(Crawler, "_root_sources", [(SimIndex, [None])])
+    links = lambda url: [ f"http://sim.test.com/{i}" for i in range(3) ] if url == "http://sim.test.com/" else []
+    # no latency: the clock stays exactly at each due time
+    site = SiteModel(1, links=links, latency=0)
+    simulator = Simulator(db.name, site, start=datetime(2024, 1, 1))
+    report = simulator.run(timedelta(days=2))
+    assert report.fetches == {"sim_index": 8, "sim_article": 6}
+    assert db.request_history.count_documents({"status": "failed"}) == 0
+    assert len(report.queue_sizes) == 49
@@ -0,0 +1,113 @@
+from ..syncrawl import (
+    CrawlStats,
+    Key,
+    Page,
+    PageRequest,
+    ParsingOutput,
+    RequestQueue,
+    VirtualClock,
+    register_page,
+)
+
+from datetime import datetime, timedelta
+
+START = datetime(2024, 1, 1, 12, 0, 30)
+
+@register_page
+class StatsPage(Page):
+    __slots__ = ()
+    page_name = "stats_page"
+    def url(self):
+        return f"http://test.com/stats/{self['id']}"
+    def next_update_at(self, last_updated_at):
+        return None
+    def parse(self, html):
+        return ParsingOutput()
+
+class CallCounter:
+    # wraps a collection, counting its write calls
+    def __init__(self, collection, on_bulk_write=None):
+        self._collection = collection
+        self._on_bulk_write = on_bulk_write
+        self.n_writes = 0
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+    def bulk_write(self, *args, **kwargs):
+        self.n_writes += 1
+        if self._on_bulk_write is not None:
+            on_bulk_write, self._on_bulk_write = self._on_bulk_write, None
+            on_bulk_write()
+        return self._collection.bulk_write(*args, **kwargs)
+
+def counts_of(db, page_name):
+    doc = db.crawl_stats.find_one({"_id": page_name})
+    return { field: n for field, n in doc.items() if field != "_id" and n != 0 }
+
+
+# CrawlStats
+
+def test_transitions_and_buckets(db):
+    clock = VirtualClock(START)
+    stats = CrawlStats(db, clock)
+    stats.transition("p", None, "pending", 3)
+    stats.transition("p", "pending", "processing")
+    stats.transition("p", "processing", "completed")
+    stats.items_changed("p", 5, 2)
+    assert counts_of(db, "p") == {"pending": 2, "completed": 1, "items": 3}
+    bucket = stats.throughput(START)[0]
+    assert bucket["_id"] == datetime(2024, 1, 1, 12, 0)
+    assert (bucket["enqueued"], bucket["completed"], bucket["items"], bucket["pending_delta"]) == (3, 1, 5, 2)
+
+def test_batched_transitions_are_written_once(db):
+    stats = CrawlStats(db, VirtualClock(START))
+    stats._cs = CallCounter(db.crawl_stats)
+    with stats.batch():
+        stats.transition("p", None, "pending", 2)
+        with stats.batch():
+            stats.transition("p", "pending", "processing")
+        assert stats._cs.n_writes == 0
+        stats.transition("p", "processing", "completed")
+    assert stats._cs.n_writes == 1
+    assert counts_of(db, "p") == {"pending": 1, "completed": 1}
+
+def test_rebuild(db):
+    clock = VirtualClock(START)
+    queue = RequestQueue(db, clock=clock)
+    queue.add_requests([ PageRequest(StatsPage(Key(id=i)), None, clock.now()) for i in range(3) ])
+    clock.sleep(1)
+    queue.end_request(queue.get_next_request())
+    queue.get_next_request()
+    expected = counts_of(db, "stats_page")
+    assert expected == {"pending": 1, "processing": 1, "completed": 1}
+    db.crawl_stats.drop()
+    CrawlStats(db).rebuild()
+    assert counts_of(db, "stats_page") == expected
+
+
+# RequestQueue rollups
+
+def test_lease_cycle_writes_rollups_once(db):
+    clock = VirtualClock(START)
+    queue = RequestQueue(db, max_processing_time=60, clock=clock)
+    queue.add_requests([ PageRequest(StatsPage(Key(id=i)), None, clock.now()) for i in range(2) ])
+    clock.sleep(1)
+    leased = queue.get_next_request()
+    db.request_queue.update_one({"_id": {"$ne": leased.id}}, {"$set": {"retries": 3}})
+    clock.sleep(120)
+    queue._stats._cs = CallCounter(db.crawl_stats)
+    # recovers the stale request, fails the exhausted one and leases, with one rollup write
+    assert queue.get_next_request().id == leased.id
+    assert queue._stats._cs.n_writes == 1
+    assert counts_of(db, "stats_page") == {"processing": 1, "failed": 1}
+
+def test_concurrent_moves_are_counted_once(db):
+    clock = VirtualClock(START)
+    queue = RequestQueue(db, clock=clock)
+    other = RequestQueue(db, clock=clock)
+    queue.add_requests([ PageRequest(StatsPage(Key(id=i)), None, clock.now()) for i in range(2) ])
+    db.request_queue.update_many({}, {"$set": {"retries": 3}})
+    # another worker moves the same failed requests while this one is at it
+    queue._rh = CallCounter(db.request_history, on_bulk_write=other._check_failed_requests)
+    queue._check_failed_requests()
+    assert counts_of(db, "stats_page") == {"failed": 2}
+    assert db.request_history.count_documents({"status": "failed"}) == 2
@@ -0,0 +1,160 @@
+from ..syncrawl import (
+    ChangeTracker,
+    Crawler,
+    Key,
+    Item,
+    ItemStore,
+    Page,
+    PageRequest,
+    ParsingOutput,
+    RequestQueue,
+    VirtualClock,
+    WriteBuffer,
+    index_items,
+    register_page,
+)
+
+from pymongo.errors import PyMongoError
+from datetime import datetime, timedelta
+
+@register_page
+class Shop(Page):
+    page_name = "shop"
+    def url(self):
+        return f"http://test.com/shop/{self['id']}"
+    def next_update_at(self, last_updated_at):
+        return None
+    def parse(self, html):
+        return ParsingOutput()
+
+class Recorder:
+    # stands in for RequestQueue, ItemStore and ChangeTracker
+    def __init__(self):
+        self.calls = []
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((name, args))
+            return args[0] if name == "filter_archived" else 0
+        return call
+
+def request(i):
+    return PageRequest(Shop(Key(id=i)), None, datetime.now(), id_=i)
+
+
+# WriteBuffer
+
+def test_write_buffer_flush_order():
+    recorder = Recorder()
+    writes = WriteBuffer(recorder, recorder, recorder, max_writes=100, max_delay=3600)
+    now = datetime.now()
+    writes.add_items([Item("a", "t")], Shop(Key(id=1)), 1, now)
+    writes.add_items([Item("b", "t")], Shop(Key(id=1)), 2, now)
+    writes.add_items([Item("c", "t")], Shop(Key(id=1)), 2, now)
+    writes.sweep_items(Shop(Key(id=1)), 2)
+    writes.add_requests([request(2)])
+    writes.end_request(request(1))
+    assert recorder.calls == []
+    assert not writes.is_due()
+    writes.flush()
+    names = [ name for name, _ in recorder.calls ]
+    assert names.index("write_items") < names.index("sweep_items") < names.index("add_requests") < names.index("end_requests")
+    written = recorder.calls[names.index("write_items")][1][0]
+    assert [ ([ item.id for item in items ], parse_id) for _, items, parse_id, _ in written ] == [(["a"], 1), (["b", "c"], 2)]
+    recorder.calls = []
+    writes.flush()
+    assert recorder.calls == []
+
+def test_write_buffer_flushes_by_size_and_age():
+    recorder = Recorder()
+    writes = WriteBuffer(recorder, recorder, recorder, max_writes=2, max_delay=3600)
+    ended = [request(1), request(2)]
+    writes.end_request(ended[0])
+    assert recorder.calls == []
+    writes.end_request(ended[1])
+    assert ("end_requests", (ended,)) in recorder.calls
+    writes = WriteBuffer(recorder, recorder, recorder, max_writes=100, max_delay=0)
+    writes.end_request(request(3))
+    assert writes.is_due()
+
+def fail_once(f, before=False):
+    # raises on the first call, before or after running f
+    calls = []
+    def call(*args):
+        calls.append(args)
+        if before and len(calls) == 1:
+            raise PyMongoError("write failed")
+        result = f(*args)
+        if len(calls) == 1:
+            raise PyMongoError("write failed")
+        return result
+    return call
+
+def test_write_buffer_flush_fails_part_way(db, monkeypatch):
+    clock = VirtualClock(datetime(2024, 1, 1))
+    queue = RequestQueue(db, clock=clock)
+    item_store = ItemStore(db, clock)
+    writes = WriteBuffer(queue, item_store, ChangeTracker(db, clock), max_writes=100, max_delay=3600, clock=clock)
+    queue.add_requests([PageRequest(Shop(Key(id=1)), None, clock.now())])
+    clock.sleep(1)
+    processed = queue.get_next_request()
+    parse_id = ItemStore.new_parse_id()
+    writes.add_items([Item("a", "t"), Item("b", "t")], processed.page, parse_id, clock.now())
+    writes.sweep_items(processed.page, parse_id)
+    writes.add_requests([PageRequest(Shop(Key(id=2)), None, clock.now())])
+    writes.reschedule(PageRequest(processed.page, processed.next_update_at, clock.now() + timedelta(days=1)), processed.id)
+    writes.end_request(processed)
+    monkeypatch.setattr(queue, "reschedule_requests", fail_once(queue.reschedule_requests))
+    monkeypatch.setattr(queue, "end_requests", fail_once(queue.end_requests, before=True))
+    # the reschedule is written, then reported as failed
+    assert not writes.flush()
+    assert db.request_queue.find_one({"_id": processed.id})["status"] == "processing"
+    # written again, and the ended request fails
+    assert not writes.flush()
+    assert writes.flush()
+    assert db.item_store.count_documents({}) == 2
+    assert db.request_history.find_one({"_id": processed.id})["status"] == "completed"
+    pending = sorted(doc["payload"]["page"]["key"]["id"] for doc in db.request_queue.find({"status": "pending"}))
+    assert pending == [1, 2]
+
+def test_write_buffer_drops_writes_after_max_failures():
+    class Failing(Recorder):
+        def end_requests(self, requests):
+            raise PyMongoError("write failed")
+    failing = Failing()
+    writes = WriteBuffer(failing, failing, failing, max_writes=1, max_delay=3600, max_failures=3)
+    writes.end_request(request(1))
+    # retries wait for flush_if_due
+    writes.end_request(request(2))
+    assert writes.is_due()
+    writes.flush_if_due()
+    assert not writes.flush()
+    assert not writes.is_due()
+
+def test_write_items_drops_unique_violations(db):
+    index_items("unique_t", "sku", unique=True)
+    try:
+        item_store = ItemStore(db)
+    finally:
+        Item._indexes.pop("unique_t")
+    parse_id = ItemStore.new_parse_id()
+    item_store.write_items([
+        (Shop(Key(id=1)), [Item("a", "unique_t", {"sku": "x"}), Item("b", "unique_t", {"sku": "y"})], parse_id, datetime.now()),
+        (Shop(Key(id=2)), [Item("c", "unique_t", {"sku": "x"})], parse_id, datetime.now()),
+    ])
+    assert sorted(doc["item"]["_id"] for doc in db.item_store.find()) == ["a", "b"]
+
+def test_crawler_write_buffer(db):
+    clock = VirtualClock(datetime(2024, 1, 1))
+    crawler = Crawler(db.name, None, write_behind=True, write_interval=60, clock=clock)
+    writes = crawler._writes
+    writes.end_request(request(1))
+    # the buffer ages on the crawler's clock
+    assert not writes.is_due()
+    clock.sleep(60)
+    assert writes.is_due()
+    # a failed flush is logged, not raised
+    def fail(requests):
+        raise PyMongoError("write failed")
+    crawler._request_queue.end_requests = fail
+    writes.flush_if_due()
+    assert writes.is_due()
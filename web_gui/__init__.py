@@ -40,7 +40,7 @@ def jinja_filter__format_key(value):
     return Markup(items)
 
 def jinja_filter__format_item(value):
-    items = ', '.join(f'<strong>{key}</strong>: {val}' for key, val in value.items() if key != '_type')
+    items = ', '.join(f'<strong>{key}</strong>: {val}' for key, val in value.items() if not key.startswith('_'))
     return Markup(items)
 
 def jinja_filter__format_datetime(value):
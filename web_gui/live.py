@@ -0,0 +1,111 @@
+from . import utils
+
+from flask import current_app, get_template_attribute
+from pymongo.errors import PyMongoError
+
+from datetime import datetime
+import itertools
+import json
+import time
+
+# view -> where its rows live and how to render one. The queue view also
+# follows request_history, where finished requests move to, to drop their rows
+views = {
+    'queue': {
+        'collections': ['request_queue', 'request_history'],
+        'status': 'pending',
+        'row': 'pending_row',
+        'watermark': 'status_updated_at',
+        'get_page_f': lambda e: e['payload']['page'],
+    },
+    'completed': {
+        'collections': ['request_history'],
+        'status': 'completed',
+        'row': 'completed_row',
+        'watermark': 'status_updated_at',
+        'get_page_f': lambda e: e['payload']['page'],
+    },
+    'failed': {
+        'collections': ['request_history'],
+        'status': 'failed',
+        'row': 'failed_row',
+        'watermark': 'status_updated_at',
+        'get_page_f': lambda e: e['payload']['page'],
+    },
+    'data': {
+        'collections': ['item_store'],
+        'status': None,
+        'row': 'item_row',
+        'watermark': 'parsed_at',
+        'get_page_f': lambda e: e['page'],
+    },
+}
+
+def format_event(data):
+    return f"data: {json.dumps(data)}\n\n"
+
+def row_event(view, doc, request):
+    config = views[view]
+    in_view = config['status'] is None or doc.get('status') == config['status']
+    if in_view:
+        in_view = len(utils.filter_by_pages([doc], config['get_page_f'], request)) == 1
+    if in_view and view == 'data':
+        in_view = len(utils.filter_by_items([doc], lambda e: e['item'], request)) == 1
+    if not in_view:
+        return {"op": "remove", "id": str(doc['_id'])}
+    render_row = get_template_attribute('rows.html', config['row'])
+    return {"op": "upsert", "id": str(doc['_id']), "html": str(render_row(doc))}
+
+def watch_changes(db, collections, heartbeat):
+    # yields changed documents ({'_id'} only for deletions), None on idle
+    pipeline = [{'$match': {'ns.coll': {'$in': collections}}}]
+    with db.watch(pipeline, full_document='updateLookup', max_await_time_ms=heartbeat*1000) as stream:
+        while stream.alive:
+            change = stream.try_next()
+            if change is None:
+                yield None
+            elif change['operationType'] == 'delete':
+                yield change['documentKey']
+            elif change.get('fullDocument') is not None:
+                yield change['fullDocument']
+
+def poll_changes(db, collections, watermark_field, interval, batch_size=500):
+    # deletions are not visible here, only inserts and updates
+    watermarks = { name: datetime.now() for name in collections }
+    while True:
+        caught_up = True
+        for name in collections:
+            docs = list(db[name].find({watermark_field: {"$gt": watermarks[name]}}).sort(watermark_field, 1).limit(batch_size))
+            for doc in docs:
+                watermarks[name] = max(watermarks[name], doc[watermark_field])
+                yield doc
+            caught_up = caught_up and len(docs) < batch_size
+        if caught_up:
+            yield None
+            time.sleep(interval)
+
+def stream_events(view, request):
+    mongo = current_app.config['MONGO']
+    config = views[view]
+    heartbeat = current_app.config.get('LIVE_HEARTBEAT', 15)
+    poll_interval = current_app.config.get('LIVE_POLL_INTERVAL', 2)
+    try:
+        changes = watch_changes(mongo.db, config['collections'], heartbeat)
+        changes = itertools.chain([next(changes)], changes)
+    except PyMongoError:
+        # change streams need a replica set
+        changes = poll_changes(mongo.db, config['collections'], config['watermark'], poll_interval)
+    yield ": connected\n\n"
+    last_sent = time.time()
+    for doc in changes:
+        if doc is None:
+            if time.time() - last_sent >= heartbeat:
+                last_sent = time.time()
+                yield ": heartbeat\n\n"
+            continue
+        if len(doc) == 1:
+            event = {"op": "remove", "id": str(doc['_id'])}
+        else:
+            event = row_event(view, doc, request)
+        last_sent = time.time()
+        yield format_event(event)
@@ -1,6 +1,9 @@
 from . import utils
+from . import live
 
-from flask import request, Blueprint, render_template, current_app, redirect
+from flask import request, Blueprint, render_template, current_app, redirect, Response, stream_with_context, abort
+
+from datetime import datetime, timedelta
 
 import pdb
 
@@ -16,7 +19,7 @@ def request_queue():
     data = mongo.db.request_queue.find({"status": "pending"}).sort("payload.next_update_at", 1)
     get_page_f = lambda e: e['payload']['page']
     data = utils.filter_by_pages(data, get_page_f, request)
-    available_page_names = mongo.db.request_queue.distinct("payload.page.page_name")
+    available_page_names = utils.get_page_names(mongo)
     return render_template(
         'pending_requests.html',
         data=data,
@@ -27,10 +30,10 @@ def request_queue():
 @main_bp.route('/completed')
 def completed_requests():
     mongo = current_app.config['MONGO']
-    data = mongo.db.request_queue.find({"status": "completed"}).sort("payload.last_updated_at", -1)
+    data = mongo.db.request_history.find({"status": "completed"}).sort("payload.last_updated_at", -1)
     get_page_f = lambda e: e['payload']['page']
     data = utils.filter_by_pages(data, get_page_f, request)
-    available_page_names = mongo.db.request_queue.distinct("payload.page.page_name")
+    available_page_names = utils.get_page_names(mongo)
     return render_template(
         'completed_requests.html',
         data=data,
@@ -41,10 +44,10 @@ def completed_requests():
 @main_bp.route('/failed')
 def failed_requests():
     mongo = current_app.config['MONGO']
-    data = mongo.db.request_queue.find({"status": "failed"}).sort("payload.last_updated_at", -1)
+    data = mongo.db.request_history.find({"status": "failed"}).sort("payload.last_updated_at", -1)
     get_page_f = lambda e: e['payload']['page']
     data = utils.filter_by_pages(data, get_page_f, request)
-    available_page_names = mongo.db.request_queue.distinct("payload.page.page_name")
+    available_page_names = utils.get_page_names(mongo)
     return render_template(
         'failed_requests.html',
         data=data,
@@ -58,7 +61,7 @@ def archived_pages():
     data = mongo.db.archived_pages.find().sort("payload.archived_at", -1)
     get_page_f = lambda e: e
     data = utils.filter_by_pages(data, get_page_f, request)
-    available_page_names = mongo.db.request_queue.distinct("payload.page.page_name")
+    available_page_names = utils.get_page_names(mongo)
     return render_template(
         'archived_pages.html',
         data=data,
@@ -69,13 +72,13 @@ def archived_pages():
 @main_bp.route('/data')
 def data_items():
     mongo = current_app.config['MONGO']
-    data = mongo.db.item_store.find().sort("parsed_at", -1)
+    data = mongo.db.item_store.find(utils.item_query(request)).sort("parsed_at", -1)
     get_page_f = lambda e: e['page']
     get_item_f = lambda e: e['item']
     data = utils.filter_by_pages(data, get_page_f, request)
     data = utils.filter_by_items(data, get_item_f, request)
     available_item_types = mongo.db.item_store.distinct("item._type")
-    available_page_names = mongo.db.item_store.distinct("page.page_name")
+    available_page_names = utils.get_page_names(mongo)
     return render_template(
         'crawled_data.html',
         data=data,
@@ -83,3 +86,31 @@ def data_items():
         page_names=available_page_names,
         query_params=request.args,        
     )
+
+@main_bp.route('/stats')
+def crawl_stats():
+    mongo = current_app.config['MONGO']
+    minutes = request.args.get('minutes', 60, type=int)
+    counts = list(mongo.db.crawl_stats.find().sort("_id", 1))
+    since = (datetime.now() - timedelta(minutes=minutes)).replace(second=0, microsecond=0)
+    buckets = list(mongo.db.crawl_throughput.find({"_id": {"$gte": since}}).sort("_id", 1))
+    totals = utils.sum_counts(counts)
+    utils.add_backlog(buckets, totals["pending"])
+    return render_template(
+        'crawl_stats.html',
+        counts=counts,
+        totals=totals,
+        buckets=buckets,
+        minutes=minutes,
+        query_params=request.args,
+    )
+
+@main_bp.route('/events/<view>')
+def live_events(view):
+    if view not in live.views:
+        abort(404)
+    return Response(
+        stream_with_context(live.stream_events(view, request)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
@@ -0,0 +1,42 @@
+// Patches table rows in place from the server-sent events of /events/<view>
+function startLiveUpdates(url, tbody) {
+    if (!window.EventSource || tbody === null) {
+        return;
+    }
+    var order = tbody.dataset.order;
+    var source = new EventSource(url);
+    source.onmessage = function(e) {
+        var event = JSON.parse(e.data);
+        var existing = document.getElementById("row-" + event.id);
+        if (existing !== null) {
+            existing.remove();
+        }
+        if (event.op === "upsert") {
+            var container = document.createElement("tbody");
+            container.innerHTML = event.html.trim();
+            var row = container.firstElementChild;
+            tbody.insertBefore(row, findNextRow(tbody, row, order));
+        }
+        renumberRows(tbody);
+    };
+}
+
+function findNextRow(tbody, row, order) {
+    if (order !== "asc") {
+        return tbody.firstElementChild;
+    }
+    var sort = parseFloat(row.dataset.sort);
+    for (var i = 0; i < tbody.rows.length; i++) {
+        if (parseFloat(tbody.rows[i].dataset.sort) > sort) {
+            return tbody.rows[i];
+        }
+    }
+    return null;
+}
+
+function renumberRows(tbody) {
+    var cells = tbody.querySelectorAll("td.position");
+    for (var i = 0; i < cells.length; i++) {
+        cells[i].textContent = i + 1;
+    }
+}
@@ -1,5 +1,20 @@
 from flask import current_app
 
+stat_fields = ["pending", "processing", "completed", "failed", "items"]
+
+def get_page_names(mongo):
+    return sorted(mongo.db.crawl_stats.distinct("_id"))
+
+def sum_counts(counts):
+    return { field: sum([ e.get(field, 0) for e in counts ]) for field in stat_fields }
+
+def add_backlog(buckets, current_pending):
+    # walk backwards from the current backlog undoing each minute's pending delta
+    backlog = current_pending
+    for bucket in reversed(buckets):
+        bucket['backlog'] = backlog
+        backlog -= bucket.get('pending_delta', 0)
+
 def filter_by_pages(data, get_page_f, request):
     page_name = request.args.get('page_name', '')
     page_key_pattern = request.args.get('page_key', '')
@@ -21,6 +36,17 @@ def filter_by_search_key(data, get_page_f, pattern):
             result.append(e)
     return result
 
+def item_query(request):
+    # the exact-match filters, answered by item_store indexes instead of a scan
+    query = {}
+    page_name = request.args.get('page_name', '')
+    item_type = request.args.get('item_type', '')
+    if page_name.strip() != "":
+        query['page.page_name'] = page_name
+    if item_type.strip() != "":
+        query['item._type'] = item_type
+    return query
+
 def filter_by_items(data, get_item_f, request):
     item_type = request.args.get('item_type', '')
     item_pattern = request.args.get('item_pattern', '')